@@ -9,6 +9,21 @@ import pickle
 import warnings
 import random
 import traceback
+import time
+import threading
+from functools import partial, wraps
+from collections import OrderedDict
+import sqlite3
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import itertools
+import io
+import struct
+import zlib
+import lzma
+import bz2
+import pathlib
 
 import binfootprint as bf
 import progression as progress
@@ -17,6 +32,12 @@ import logging
 
 log = logging.getLogger(__name__)
 
+try:
+    import fcntl
+except ImportError:
+    # not available on windows, no reflinks (see _reflink)
+    fcntl = None
+
 try:
     import numpy as np
 
@@ -33,6 +54,303 @@ TYPE_SUB = 0x01
 TYPE_NPA = 0x02
 TYPE_LOAD_ERR = 0x03
 
+# max number of keys per SQL statement for bulk operations
+SQL_CHUNK_SIZE = 400
+
+# number of rows fetched per query by keys(), items() and values()
+FETCH_SIZE = 256
+
+# marks a missing default argument
+_NO_DEFAULT = object()
+
+# target size of the chunk files of arrays written by append_array
+APPEND_CHUNK_BYTES = 2**20
+
+# ways to transfer files between stores, see the option link_mode
+LINK_MODES = ("copy", "hardlink", "reflink", "auto")
+
+# ioctl request which clones a file (copy on write), linux only
+FICLONE = 0x40049409
+
+# tables holding the sub-data of a single file store
+SUBDATA_TABLE = "subdata"
+SUBDATA_NODES_TABLE = "subdata_nodes"
+
+
+# prefix of values in the db which are compressed, followed by the name of the
+# codec and a zero byte (pickled data never starts with a zero byte)
+COMPRESSED_SIGN = b"\x00PDS"
+
+# name -> (compress(data, level), decompress(data)), see register_codec
+CODECS = {}
+
+
+def register_codec(name, compress, decompress):
+    """
+    make a compression codec available for the option 'compression'
+
+    compress(data, level) returns the compressed bytes (level is None for the
+    default level of the codec), decompress(data) returns the original bytes
+    (data is a bytes-like object).
+    The name is stored with each compressed value, so the same codecs need to be
+    registered to read the data.
+    """
+    if (not name) or ("\x00" in name) or (not name.isascii()):
+        raise ValueError("invalid codec name {!r}".format(name))
+    CODECS[name] = (compress, decompress)
+
+
+register_codec(
+    "zlib",
+    lambda d, level: zlib.compress(d, -1 if level is None else level),
+    zlib.decompress,
+)
+register_codec("lzma", lambda d, level: lzma.compress(d, preset=level), lzma.decompress)
+register_codec(
+    "bz2",
+    lambda d, level: bz2.compress(d, 9 if level is None else level),
+    bz2.decompress,
+)
+
+# prefix of ordinary values in the db which are not pickled by the sqlitedict,
+# followed by the name of the serializer and a zero byte
+SERIALIZED_SIGN = b"\x01PDS"
+
+# name -> (dumps(value), loads(data)), see register_serializer
+SERIALIZERS = {}
+
+
+def register_serializer(name, dumps, loads):
+    """
+    make a serializer available for the option 'serializer'
+
+    dumps(value) returns bytes, loads(data) returns the value (data is a bytes-like
+    object). As for the codecs, the name is stored with each value.
+    """
+    if (not name) or ("\x00" in name) or (not name.isascii()):
+        raise ValueError("invalid serializer name {!r}".format(name))
+    SERIALIZERS[name] = (dumps, loads)
+
+
+def _pickle5_dumps(value):
+    """
+    pickle with protocol 5, large buffers (e.g. numpy arrays) are not copied into
+    the pickle stream but appended as separate blocks
+
+    layout: number of buffers n, n buffer sizes, the buffers, the pickle data
+    """
+    buffers = []
+    data = pickle.dumps(value, protocol=5, buffer_callback=buffers.append)
+    buffers = [b.raw() for b in buffers]
+    head = struct.pack(
+        "<I%dQ" % len(buffers), len(buffers), *[b.nbytes for b in buffers]
+    )
+    return b"".join([head] + buffers + [data])
+
+
+def _pickle5_loads(data):
+    # a single writable copy of the data, the buffers are views into it
+    data = memoryview(bytearray(data))
+    (n,) = struct.unpack_from("<I", data)
+    sizes = struct.unpack_from("<%dQ" % n, data, 4)
+    offset = 4 + 8 * n
+    buffers = []
+    for size in sizes:
+        buffers.append(data[offset : offset + size])
+        offset += size
+    return pickle.loads(data[offset:], buffers=buffers)
+
+
+register_serializer("pickle5", _pickle5_dumps, _pickle5_loads)
+register_serializer("binfootprint", bf.dump, lambda data: bf.load(bytes(data)))
+
+
+def _prefix_upper_bound(prefix):
+    """
+    the smallest str (bytes) which is larger than all str (bytes) starting with
+    prefix, or None if there is no such value
+    """
+    if isinstance(prefix, str):
+        max_item = 0x10FFFF
+        items = [ord(c) for c in prefix]
+    else:
+        max_item = 0xFF
+        items = list(prefix)
+    while items and (items[-1] == max_item):
+        items.pop()
+    if not items:
+        return None
+    items[-1] += 1
+    if 0xD800 <= items[-1] <= 0xDFFF:
+        # skip the surrogates (not valid in UTF-8)
+        items[-1] = 0xE000
+    if isinstance(prefix, str):
+        return "".join(chr(i) for i in items)
+    return bytes(items)
+
+
+class _ReadOnlySqliteMultithread(sqd.SqliteMultithread):
+    """
+    connection thread of the sqlitedict which opens the db read-only (sqlite URI
+    with mode=ro, optionally immutable=1) and does not modify the journal mode
+    """
+
+    def __init__(self, filename, immutable, outer_stack=True):
+        self.uri = pathlib.Path(filename).absolute().as_uri() + "?mode=ro"
+        if immutable:
+            self.uri += "&immutable=1"
+        super().__init__(
+            filename, autocommit=False, journal_mode=None, outer_stack=outer_stack
+        )
+
+    def _connect(self):
+        try:
+            conn = sqlite3.connect(self.uri, uri=True, check_same_thread=False)
+            conn.text_factory = str
+            cursor = conn.cursor()
+        except Exception:
+            self.log.exception("Failed to open read-only connection: %s" % self.uri)
+            self.exception = sys.exc_info()
+            raise
+        return conn, cursor
+
+
+class _ReadOnlySqliteDict(sqd.SqliteDict):
+    def __init__(self, filename, immutable=False):
+        self.immutable = immutable
+        super().__init__(filename=filename, flag="r", autocommit=False)
+
+    def _new_conn(self):
+        return _ReadOnlySqliteMultithread(
+            self.filename, self.immutable, outer_stack=self._outer_stack
+        )
+
+
+def _reflink(src, dst):
+    """
+    make dst a copy on write clone of src, raises OSError if this is not supported
+    (by the os or the file system, or if src and dst are on different file systems)
+    """
+    if fcntl is None:
+        raise OSError("reflinks are not supported on this platform")
+    with open(src, "rb") as f_src, open(dst, "wb") as f_dst:
+        fcntl.ioctl(f_dst.fileno(), FICLONE, f_src.fileno())
+
+
+def _transfer_file(src, dst, link_mode, shared=True):
+    """
+    create (or overwrite) the file dst with the content of src as given by
+    link_mode (see the option link_mode), falls back to copying if a link is not
+    possible
+
+    a hard link is only used if shared is True, i.e., if the file is never modified
+    in place, returns the way the file has been transferred
+    """
+    if shared and (link_mode in ("hardlink", "auto")):
+        # dst may exist (see _new_rand_file_name), link to a unique name and rename
+        tmp = dst + ".link"
+        try:
+            os.link(src, tmp)
+        except OSError:
+            pass
+        else:
+            os.replace(tmp, dst)
+            return "hardlink"
+    if link_mode in ("reflink", "auto"):
+        try:
+            _reflink(src, dst)
+        except OSError:
+            pass
+        else:
+            return "reflink"
+    shutil.copyfile(src, dst)
+    return "copy"
+
+
+def _unshare_file(path):
+    """
+    replace a file which has several hard links by a copy, so it can be modified
+    in place
+    """
+    if os.stat(path).st_nlink > 1:
+        tmp = path + ".unshare"
+        shutil.copyfile(path, tmp)
+        os.replace(tmp, path)
+
+
+def _remove_tree(path, workers=1, keep=()):
+    """
+    remove the directory path with all its content, except for the entries named
+    in keep (then path itself is kept as well), with workers > 1 the directories
+    in path are removed concurrently
+    """
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for entry in os.scandir(path):
+            if entry.name in keep:
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                executor.submit(shutil.rmtree, entry.path, True)
+            else:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+    if not keep:
+        try:
+            os.rmdir(path)
+        except OSError as e:
+            warnings.warn("directory structure can not be deleted\n{}".format(e))
+
+
+def _chunks(iterable, n):
+    """
+    yield lists of (at most) n items of the iterable
+    """
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, n))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _unpickle_pds(cls, options):
+    return cls(**options)
+
+
+def _unpickle_node(root, node):
+    return root._node_pds(node)
+
+
+def _write_operation(f):
+    """
+    decorator for the methods of PersistentDataStructure which modify the db
+
+    Each call runs within a SAVEPOINT. If the method fails, its changes are rolled
+    back and the file operations it registered for commit (or rollback) are dropped
+    (or run), also inside a transaction or with autocommit=False. The changes of a
+    successful call are committed when the outermost call has finished (with
+    autocommit and outside of a transaction).
+
+    In multi writer mode the write lock is acquired before the method checks the
+    current state (e.g. if a key exists).
+    """
+
+    @wraps(f)
+    def wrapper(self, *args, **kwargs):
+        self._need_writable()
+        self.need_open()
+        op = self._op_begin()
+        try:
+            r = f(self, *args, **kwargs)
+        except BaseException:
+            self._op_end(op, success=False)
+            raise
+        self._op_end(op, success=True)
+        return r
+
+    return wrapper
+
 
 def key_to_str(key, max_len=255):
     if isinstance(key, (bytearray, bytes)):
@@ -68,28 +386,293 @@ class PersistentDataStructure(object):
     (because the pickler will essentially pickle the dictionary self.__dict__).
     If you want to use "complicated" python objects as binary keys make sure you
     implement your own pickle behavior without the need of dictionaries.
+
+    By default every modification is committed to the database immediately.
+    Use `with pds.transaction(): ...` to group many modifications into a single
+    commit, or set `autocommit=False` and call `commit()` explicitly (pending
+    changes are committed on `close()` as well).
+
+    By default each sub-data is stored in its own directory with its own sqlite
+    file. With `single_file=True` all sub-data are stored as nodes in the sqlite
+    file of the (root) PersistentDataStructure, so opening sub-data is a row lookup
+    instead of opening a new file. The mode is recorded in the file, i.e., it needs
+    to be set only when the store is created. The sub-data handles of a single file
+    store share the connection of the root and can only be used while the root is
+    open.
+
+    With `mmap_mode` (e.g. "r", see numpy.load) numpy arrays are returned as memory
+    mapped arrays by default, so large arrays can be sliced without reading the
+    whole file. It can be overwritten for a single call of getData.
+
+    Numpy arrays smaller than `npa_inline_threshold` bytes are stored inline in the
+    sqlite file (dtype, shape and raw data) instead of a separate .npy file. The
+    default of 0 stores all arrays as files (readable by older versions).
+
+    Arrays which grow over time (e.g. time series) can be extended with
+    `append_array(key, rows)`, which stores the rows in fixed size chunk files and
+    writes only the new rows.
+
+    With `compression` set to the name of a codec ("zlib", "lzma", "bz2" or any
+    codec added by register_codec) values in the sqlite file and array files are
+    compressed, `compression_level` is passed to the codec. The codec is recorded
+    with each value, so stores with mixed (or no) compression remain readable.
+    Compressed array files can not be memory mapped and appended arrays (see
+    append_array) are not compressed.
+
+    Ordinary values are pickled by the sqlitedict unless `serializer` names one of
+    the serializers "pickle5" (pickle protocol 5 with the buffers of e.g. numpy
+    arrays stored as separate blocks; on load the stored value is copied once into
+    a writable buffer and the arrays are views into that copy), "binfootprint" or
+    any serializer added by register_serializer. As for the compression, the
+    serializer is recorded with each value.
+
+    With `cache_bytes` > 0 ordinary values read by getData / get_many are kept in
+    an LRU cache of about that size (measured by the size of the stored values),
+    so repeated reads of the same keys neither query the db nor deserialize the
+    value. Note that the cached object itself is returned, i.e., modifying it
+    modifies the cached value. The cache is invalidated by all modifications made
+    through this instance, but not by modifications made by other instances or
+    processes. See cache_info() for the hit and miss counts.
+
+    With `pool_size` > 0 the handles of sub-data returned by getData are kept in a
+    pool of the root PersistentDataStructure: requesting the same sub-data again
+    returns the same (still open) instance, close() only decreases its reference
+    count. Of the handles which are not in use, all but the `pool_size` most
+    recently used ones are closed. All pooled handles are closed with the root.
+
+    With `lazy=True` the constructor only records the paths, the directories and
+    the sqlite connection are created on the first operation which needs them
+    (need_open opens the PDS instead of raising), also after close().
+
+    With `multi_writer=True` several processes can write to the same store: the
+    sqlite file uses the WAL journal (readers do not block the writer), each write
+    transaction acquires the write lock up front (BEGIN IMMEDIATE) and waits for
+    other writers for up to `busy_timeout` seconds (retrying), and new sub-data
+    directories and array files are created atomically. All processes accessing
+    the store should use this mode.
+
+    With `mode="r"` the store is opened read-only: the sqlite file is opened with
+    mode=ro (and with immutable=1 if `immutable=True`, which skips all locking and
+    must only be used if no process modifies the store), no directory is created and
+    all modifications raise a PermissionError. Stores written by an older version
+    (without value type column) are read as they are.
+
+    An instance used in a process forked from the process which opened it (e.g. by
+    a multiprocessing pool) detects the fork and opens its own connection, pending
+    changes and transactions of the parent are not inherited. Instances are pickled
+    by path and options, the unpickled instance is lazy (see above), so sending
+    them to pool workers is cheap.
+
+    `link_mode` determines how array files and sub-data directories are transferred
+    from other stores (setDataFromSubData, mergeOtherPDS): "copy" (default) copies
+    the files, "hardlink" creates hard links for array files (the sqlite files are
+    always copied), "reflink" clones the files (copy on write, e.g. on btrfs or
+    xfs), "auto" tries a hard link, then a reflink. If a link is not possible (e.g.
+    different file systems) the file is copied. Hard linked array files are shared,
+    i.e., modifying an array memory mapped with mmap_mode="r+" modifies it in both
+    stores (append_array replaces a shared chunk file by a copy before writing).
+
+    The options autocommit, mmap_mode, npa_inline_threshold, compression,
+    compression_level, serializer, cache_bytes, pool_size, lazy, multi_writer,
+    busy_timeout, mode, immutable and link_mode are inherited by sub-data.
     """
 
-    def __init__(self, name, path="./", verbose=1):
-        self._open = False
+    def __init__(
+        self,
+        name,
+        path="./",
+        verbose=1,
+        autocommit=True,
+        single_file=False,
+        mmap_mode=None,
+        npa_inline_threshold=0,
+        compression=None,
+        compression_level=None,
+        serializer=None,
+        cache_bytes=0,
+        pool_size=0,
+        lazy=False,
+        multi_writer=False,
+        busy_timeout=60,
+        mode="c",
+        immutable=False,
+        link_mode="copy",
+    ):
+        self._init_state(
+            verbose=verbose,
+            autocommit=autocommit,
+            mmap_mode=mmap_mode,
+            npa_inline_threshold=npa_inline_threshold,
+            compression=compression,
+            compression_level=compression_level,
+            serializer=serializer,
+            cache_bytes=cache_bytes,
+            pool_size=pool_size,
+            lazy=lazy,
+            multi_writer=multi_writer,
+            busy_timeout=busy_timeout,
+            mode=mode,
+            immutable=immutable,
+            link_mode=link_mode,
+        )
         self._name = name
+        self._single_file = single_file
         self._path = abspath(path)
+        self._dirname = join(self._path, "__" + self._name)
+        self._filename = join(self._dirname, self._name + ".db")
+        if not lazy:
+            if not self._read_only:
+                self._make_dirs(path)
+            # open actual sqltedict
+            self.open()
+
+    def _make_dirs(self, path=None):
         if not exists(self._path):
-            print("given path does not exists ({} -> {})".format(path, self._path))
+            print(
+                "given path does not exists ({} -> {})".format(
+                    self._path if path is None else path, self._path
+                )
+            )
             print("create path")
             os.makedirs(self._path)
 
-        self.verbose = verbose
-
         # create directory to hold sub structures
-        self._dirname = join(self._path, "__" + self._name)
         if not exists(self._dirname):
             os.mkdir(self._dirname)
 
-        # open actual sqltedict
-        self._filename = join(self._dirname, self._name + ".db")
+    def _init_state(
+        self,
+        verbose,
+        autocommit,
+        mmap_mode,
+        npa_inline_threshold,
+        compression=None,
+        compression_level=None,
+        serializer=None,
+        cache_bytes=0,
+        pool_size=0,
+        lazy=False,
+        multi_writer=False,
+        busy_timeout=60,
+        mode="c",
+        immutable=False,
+        link_mode="copy",
+    ):
+        if mode not in ("c", "r"):
+            raise ValueError("mode must be 'c' or 'r' (got {!r})".format(mode))
+        if link_mode not in LINK_MODES:
+            raise ValueError(
+                "link_mode must be one of {} (got {!r})".format(
+                    ", ".join(LINK_MODES), link_mode
+                )
+            )
+        if (compression is not None) and (compression not in CODECS):
+            raise ValueError(
+                "unknown compression codec {!r} (known are {})".format(
+                    compression, ", ".join(CODECS)
+                )
+            )
+        if (serializer is not None) and (serializer not in SERIALIZERS):
+            raise ValueError(
+                "unknown serializer {!r} (known are {})".format(
+                    serializer, ", ".join(SERIALIZERS)
+                )
+            )
+        self._open = False
+        # process which opened the db, see _check_fork()
+        self._pid = os.getpid()
+        self.verbose = verbose
+        self._lazy = lazy
+        self._multi_writer = multi_writer
+        self._busy_timeout = busy_timeout
+        self._read_only = mode == "r"
+        self._immutable = immutable
+        self._link_mode = link_mode
+        # the connection holds the write lock (multi writer mode), see _begin_write()
+        self._write_tx = False
+        self._autocommit = autocommit
+        self._mmap_mode = mmap_mode
+        self._npa_inline_threshold = npa_inline_threshold
+        self._compression = compression
+        self._compression_level = compression_level
+        self._serializer = serializer
+        # read cache, see _cache_get()
+        self._cache_bytes = cache_bytes
+        self._cache = OrderedDict()
+        self._cache_size = 0
+        self._cache_hits = 0
+        self._cache_misses = 0
+        # pool of sub-data handles, see _pooled_sub_pds()
+        self._pool_size = pool_size
+        self._pool = OrderedDict()
+        self._pool_root = None
+        self._pool_key = None
+        self._pool_refs = 0
         self._l = 8
-        self.open()
+        # transaction state, see transaction()
+        self._tx_depth = 0
+        self._tx_parent = None
+        self._tx_children = {}
+        self._tx_on_commit = []
+        self._tx_on_rollback = []
+        self._dirty = False
+        # nesting of write operations on the connection, see _op_begin()
+        self._op_depth = 0
+        self._op_finish = False
+        # node of a single file store, see _node_pds()
+        self._root = None
+        self._node = None
+        self._node_cond = ""
+        self._node_args = ()
+
+    def _node_pds(self, node):
+        """
+        return the PersistentDataStructure for a sub-data node of a single file store
+        """
+        root = self if self._root is None else self._root
+        sub_data = self.__class__.__new__(self.__class__)
+        sub_data._init_state(**self._sub_options())
+        sub_data._root = root
+        sub_data._node = node
+        sub_data._node_cond = "node = ? AND "
+        sub_data._node_args = (node,)
+        sub_data._name = "{}:{}".format(root._name, node)
+        sub_data._single_file = True
+        sub_data._path = root._path
+        sub_data._dirname = root._dirname
+        sub_data._filename = root._filename
+        if not sub_data._lazy:
+            sub_data.open()
+        return sub_data
+
+    def _sub_options(self):
+        """
+        options inherited by sub-data
+        """
+        return dict(
+            verbose=self.verbose,
+            autocommit=self._autocommit,
+            mmap_mode=self._mmap_mode,
+            npa_inline_threshold=self._npa_inline_threshold,
+            compression=self._compression,
+            compression_level=self._compression_level,
+            serializer=self._serializer,
+            cache_bytes=self._cache_bytes,
+            pool_size=self._pool_size,
+            lazy=self._lazy,
+            multi_writer=self._multi_writer,
+            busy_timeout=self._busy_timeout,
+            mode="r" if self._read_only else "c",
+            immutable=self._immutable,
+            link_mode=self._link_mode,
+        )
+
+    def _q(self, query):
+        """
+        fill in the table '{tab}' and the restriction to the node '{node}' (a prefix
+        for the WHERE clause which requires self._node_args as first arguments)
+        """
+        return query.format(tab=self._tab, node=self._node_cond)
 
     def _repair(self):
         raise DeprecationWarning
@@ -98,19 +681,23 @@ class PersistentDataStructure(object):
         raise DeprecationWarning
 
     def _new_rand_file_name(self, make_dir=False, end=""):
+        """
+        return a new random name, the (empty) file or the directory '__<name>' is
+        created atomically, so concurrent processes never get the same name
+        """
         c = 0
         while True:
             fname = rand_str(self._l) + end
-            if not make_dir:
-                full_name = join(self._dirname, fname)
-                if not os.path.exists(full_name):
-                    # open(full_name, 'a').close()
-                    return fname
-            else:
-                full_name = join(self._dirname, "__" + fname)
-                if not os.path.exists(full_name):
+            try:
+                if not make_dir:
+                    full_name = join(self._dirname, fname)
+                    os.close(os.open(full_name, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                else:
+                    full_name = join(self._dirname, "__" + fname)
                     os.mkdir(full_name)
-                    return fname
+                return fname
+            except FileExistsError:
+                pass
 
             c += 1
             if c > 10:
@@ -133,25 +720,256 @@ class PersistentDataStructure(object):
         """
         if self.verbose > 1:
             print("open db                {} in {}".format(self._name, self._dirname))
-        self.db = sqd.SqliteDict(filename=self._filename, autocommit=False)
+        self._pid = os.getpid()
+        if self._root is not None:
+            # node of a single file store
+            self._root.need_open()
+            self.db = self._root.db
+            self._tab = '"%s"' % SUBDATA_TABLE
+            self._open = True
+            return
+
+        if self._read_only:
+            self.db = _ReadOnlySqliteDict(self._filename, immutable=self._immutable)
+            self._tab = '"%s"' % self.db.tablename
+            self._init_read_only()
+            self._open = True
+            return
+
+        self.db = sqd.SqliteDict(
+            filename=self._filename,
+            autocommit=False,
+            journal_mode="WAL" if self._multi_writer else "DELETE",
+        )
+        if self._multi_writer:
+            self.db.conn.execute(
+                "PRAGMA busy_timeout = %d" % int(self._busy_timeout * 1000)
+            )
+        self._tab = '"%s"' % self.db.tablename
+        self._init_value_type_column()
+        self._init_single_file()
         self._open = True
 
+    def _init_read_only(self):
+        """
+        detect the single file mode, and, for a store without the value type column
+        (written by an older version), read the table through a temporary view with
+        vtype NULL (i.e., the type is determined from the value)
+        """
+        tables = [
+            r[0]
+            for r in self.db.conn.select(
+                "SELECT name FROM sqlite_master WHERE type = 'table'"
+            )
+        ]
+        self._single_file = SUBDATA_TABLE in tables
+        tab = self.db.tablename
+        columns = [r[1] for r in self.db.conn.select('PRAGMA table_info("%s")' % tab)]
+        if "vtype" not in columns:
+            self.db.conn.execute(
+                'CREATE TEMP VIEW "%s_typed" AS SELECT rowid AS rowid, key, value, '
+                'NULL AS vtype FROM main."%s"' % (tab, tab)
+            )
+            self._tab = 'temp."%s_typed"' % tab
+
+    def _need_writable(self):
+        if self._read_only:
+            raise PermissionError(
+                "PersistentDataStructure {} is opened read-only".format(self._name)
+            )
+
+    def _init_single_file(self):
+        """
+        create the tables for the sub-data nodes if the store is in single file mode
+        (or detect the mode from existing tables)
+        """
+        tables = [
+            r[0]
+            for r in self.db.conn.select(
+                "SELECT name FROM sqlite_master WHERE type = 'table'"
+            )
+        ]
+        if SUBDATA_TABLE in tables:
+            self._single_file = True
+        elif self._single_file:
+            self._begin_write()
+            # (IF NOT EXISTS, another process may have created the tables meanwhile)
+            self.db.conn.execute(
+                'CREATE TABLE IF NOT EXISTS "%s" '
+                "(id INTEGER PRIMARY KEY AUTOINCREMENT, parent INTEGER)"
+                % SUBDATA_NODES_TABLE
+            )
+            self.db.conn.execute(
+                'CREATE TABLE IF NOT EXISTS "%s" '
+                "(node INTEGER, key TEXT, value BLOB, vtype INTEGER, "
+                "PRIMARY KEY (node, key))" % SUBDATA_TABLE
+            )
+            self.db.conn.execute(
+                'CREATE INDEX IF NOT EXISTS "%s_vtype" ON "%s" (node, vtype)'
+                % (SUBDATA_TABLE, SUBDATA_TABLE)
+            )
+            self.db.conn.execute(
+                'CREATE INDEX IF NOT EXISTS "%s_parent" ON "%s" (parent)'
+                % (SUBDATA_NODES_TABLE, SUBDATA_NODES_TABLE)
+            )
+            self._db_commit()
+
+    def _init_value_type_column(self):
+        """
+        make sure the table has the indexed column 'vtype' which holds the type of
+        each value (TYPE_ORD, TYPE_SUB or TYPE_NPA), so the type can be checked
+        without loading the value
+
+        Stores created by an older version are migrated transparently, i.e., the
+        type of each value is determined once. Rows written without the type
+        (vtype is NULL) are still handled by loading the value.
+        """
+        tab = self.db.tablename
+        columns = [r[1] for r in self.db.conn.select('PRAGMA table_info("%s")' % tab)]
+        if "vtype" not in columns and self._multi_writer:
+            # check again holding the write lock, another process may migrate as well
+            self._begin_write()
+            columns = [
+                r[1] for r in self.db.conn.select('PRAGMA table_info("%s")' % tab)
+            ]
+        if "vtype" not in columns:
+            self.db.conn.execute('ALTER TABLE "%s" ADD COLUMN vtype INTEGER' % tab)
+            c = 0
+            last_rowid = 0
+            while True:
+                rows = list(
+                    self.db.conn.select(
+                        'SELECT rowid, value FROM "%s" WHERE rowid > ? ORDER BY rowid LIMIT ?'
+                        % tab,
+                        (last_rowid, SQL_CHUNK_SIZE),
+                    )
+                )
+                if len(rows) == 0:
+                    break
+                updates = []
+                for rowid, raw in rows:
+                    t, _ = self._decode_value_and_value_type(raw)
+                    if t != TYPE_LOAD_ERR:
+                        updates.append((t, rowid))
+                self.db.conn.executemany(
+                    'UPDATE "%s" SET vtype = ? WHERE rowid = ?' % tab, updates
+                )
+                last_rowid = rows[-1][0]
+                c += len(rows)
+            if (c > 0) and (self.verbose > 0):
+                print("added value type column for {} entries".format(c))
+        self.db.conn.execute(
+            'CREATE INDEX IF NOT EXISTS "%s_vtype" ON "%s" (vtype)' % (tab, tab)
+        )
+        self._db_commit()
+
     def is_open(self):
-        return self._open
+        return self._open and ((self._root is None) or self._root.is_open())
 
     def is_closed(self):
-        return not self._open
+        return not self.is_open()
 
     def need_open(self):
+        self._check_fork()
         if self.is_closed():
-            raise RuntimeError("PersistentDataStructure needs to be open")
+            if not self._lazy:
+                raise RuntimeError("PersistentDataStructure needs to be open")
+            self._open_lazy()
+
+    def _check_fork(self, reopen=True):
+        """
+        if the process has been forked since the db was opened, drop the connection
+        of the parent (its worker thread does not exist in this process) and the
+        state of the parent (pending changes, transaction, cache) and reopen the db
+        """
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        was_open = self._open
+        if (self._root is None) and was_open:
+            self.db.close(do_log=False, force=True)
+        self._tx_depth = 0
+        self._tx_parent = None
+        self._tx_children = {}
+        self._tx_on_commit = []
+        self._tx_on_rollback = []
+        self._dirty = False
+        self._write_tx = False
+        self._op_depth = 0
+        self._op_finish = False
+        self._cache_invalidate()
+        self._open = False
+        if was_open and reopen:
+            if self.verbose > 1:
+                print(
+                    "reopen after fork      {} in {}".format(self._name, self._dirname)
+                )
+            self.open()
+
+    def __reduce__(self):
+        """
+        pickle by path and options, the unpickled instance is lazy
+        """
+        if self._root is not None:
+            # the root is pickled with the options
+            return _unpickle_node, (self._root, self._node)
+        options = self._sub_options()
+        options["lazy"] = True
+        options.update(name=self._name, path=self._path, single_file=self._single_file)
+        return _unpickle_pds, (self.__class__, options)
+
+    def _open_lazy(self):
+        """
+        open a lazy PDS on first use (creating the directories if needed)
+        """
+        if self._tx_parent is not None:
+            # the close was deferred until the transaction of the parent has
+            # finished, the connection is still there
+            self._open = True
+            return
+        if (self._root is None) and not self._read_only:
+            self._make_dirs()
+        self.open()
 
     def close(self):
         """
         close the sqligtedict ans therefore the SQL database
+
+        Pending changes are committed, unless the instance is inside a
+        transaction which has not finished yet. In that case the changes are
+        rolled back. Sub-data enlisted in the transaction of its parent stays
+        connected until the parent transaction has finished.
         """
+        self._check_fork(reopen=False)
+        if self._tx_parent is not None:
+            self._open = False
+            if self.verbose > 1:
+                print(
+                    "defer close until transaction of parent has finished {} in {}".format(
+                        self._name, self._dirname
+                    )
+                )
+            return
+
+        if self._open and self._dirty:
+            self._finish(commit=(self._tx_depth == 0))
+
+        if self._pool_root is not None:
+            # pooled handle, stays open until it is evicted from the pool
+            self._pool_refs = max(0, self._pool_refs - 1)
+            if self._pool_refs == 0:
+                self._pool_root._pool_evict()
+            return
+
+        for sub_data in list(self._pool.values())[::-1]:
+            sub_data._pool_root = None
+            sub_data.close()
+        self._pool.clear()
+        self._cache_invalidate()
+
         try:
-            self.db.close()
+            if self._root is None:
+                self.db.close()
             self._open = False
             if self.verbose > 1:
                 print(
@@ -163,26 +981,431 @@ class PersistentDataStructure(object):
                     "db seem already closed {} in {}".format(self._name, self._dirname)
                 )
 
-    def erase(self):
+    @contextmanager
+    def transaction(self):
+        """
+        group all modifications made inside the with-block into a single commit
+
+            with pds.transaction():
+                for k, v in results:
+                    pds[k] = v
+
+        If an exception is raised inside the block all changes are rolled back,
+        including newly created sub-data directories and array files. Files which
+        belong to deleted entries are removed only when the transaction commits.
+
+        Sub-data returned by getData / newSubData inside the block join the
+        transaction, i.e., their commit (or rollback) is deferred until the
+        block of the parent finishes.
+        Nested transaction blocks are flattened into the outermost one.
+
+        Sub-data of a single file store shares the sqlite transaction with the
+        root, so its transaction is a transaction of the root (which the sub-data
+        joins).
+        """
+        self.need_open()
+        if (self._root is not None) and (self._tx_parent is None):
+            with self._root.transaction():
+                self._join_root_tx()
+                with self.transaction():
+                    yield self
+            return
+        self._tx_depth += 1
+        try:
+            yield self
+        except BaseException:
+            self._tx_depth -= 1
+            # within a write operation, the operation rolls back (see _op_end)
+            if (self._tx_depth == 0) and (self._op_depth == 0):
+                self._finish(commit=False)
+            raise
+        else:
+            self._tx_depth -= 1
+            if self._tx_depth == 0:
+                if self._op_depth == 0:
+                    self._finish(commit=True)
+                else:
+                    self._op_finish = True
+
+    def in_transaction(self):
+        return self._tx_depth > 0
+
+    def commit(self):
+        """
+        commit all pending changes (only needed with autocommit=False)
+
+        for sub-data of a single file store the root commits (see transaction)
+        """
+        self.need_open()
+        if self._root is not None:
+            return self._root.commit()
+        if self._tx_depth > 0:
+            raise RuntimeError("can not commit inside a transaction")
+        self._finish(commit=True)
+
+    def rollback(self):
+        """
+        discard all pending changes (only useful with autocommit=False)
+
+        for sub-data of a single file store the root rolls back (see transaction)
+        """
+        self.need_open()
+        if self._root is not None:
+            return self._root.rollback()
+        if self._tx_depth > 0:
+            raise RuntimeError("can not rollback inside a transaction")
+        self._finish(commit=False)
+
+    def _commit(self):
+        """
+        called after each modification, commits unless the commit is deferred
+        by a transaction or autocommit=False
+        """
+        self._dirty = True
+        self._join_root_tx()
+        if (
+            self._autocommit
+            and (self._tx_depth == 0)
+            and (self._db_root()._op_depth == 0)
+        ):
+            self._finish(commit=True)
+
+    def _op_begin(self):
+        """
+        start a write operation (see _write_operation): open the transaction and
+        set a savepoint, return the state needed by _op_end
+        """
+        root = self._db_root()
+        if self._multi_writer:
+            self._begin_write()
+        else:
+            # any DML opens the transaction (the sqlite3 module issues BEGIN), a
+            # SAVEPOINT outside of a transaction would commit on RELEASE
+            self.db.conn.execute(self._q("DELETE FROM {tab} WHERE 0"))
+        root._op_depth += 1
+        name = "pds_op%d" % root._op_depth
+        self.db.conn.execute("SAVEPOINT " + name)
+        self._join_root_tx()
+        marks = {
+            id(h): (len(h._tx_on_commit), len(h._tx_on_rollback))
+            for h in self._op_handles()
+        }
+        return name, marks
+
+    def _op_handles(self):
+        """
+        the instances sharing the connection whose file operations belong to the
+        current write operation
+        """
+        root = self._db_root()
+        handles = {id(self): self, id(root): root}
+        for h in [self, root]:
+            for child in h._tx_children.values():
+                if child.db is self.db:
+                    handles[id(child)] = child
+        return handles.values()
+
+    def _op_end(self, op, success):
+        """
+        finish the write operation started by _op_begin
+        """
+        name, marks = op
+        root = self._db_root()
+        root._op_depth -= 1
+        outermost = (root._op_depth == 0) and (root._tx_depth == 0)
+        if success:
+            self.db.conn.execute("RELEASE " + name)
+            root._dirty = True
+            if outermost and (self._autocommit or root._op_finish):
+                root._op_finish = False
+                root._finish(commit=True)
+            return
+
+        if outermost and self._autocommit:
+            # nothing else is pending, roll back the whole transaction
+            root._op_finish = False
+            root._dirty = True
+            root._finish(commit=False)
+            return
+
+        self.db.conn.select_one("ROLLBACK TO " + name)
+        self.db.conn.execute("RELEASE " + name)
+        if outermost:
+            root._op_finish = False
+        callbacks = []
+        for h in self._op_handles():
+            n_commit, n_rollback = marks.get(id(h), (0, 0))
+            callbacks += h._tx_on_rollback[n_rollback:][::-1]
+            del h._tx_on_commit[n_commit:]
+            del h._tx_on_rollback[n_rollback:]
+            h._cache_invalidate()
+        for f in callbacks:
+            f()
+
+    def _join_root_tx(self):
+        """
+        enlist sub-data of a single file store in the transaction of its root, if
+        the root is inside a transaction or a write operation (or with
+        autocommit=False), as they share the sqlite transaction
+        """
+        root = self._root
+        if (root is None) or (self._tx_parent is not None):
+            return
+        if (root._tx_depth == 0) and (root._op_depth == 0) and self._autocommit:
+            return
+        self._tx_parent = root
+        self._tx_depth += 1
+        root._tx_children[self._node] = self
+        root._dirty = True
+
+    def _db_root(self):
+        """
+        the instance which owns the db connection
+        """
+        return self if self._root is None else self._root
+
+    def _db_commit(self):
+        self.db.commit()
+        self._db_root()._write_tx = False
+
+    def _begin_write(self):
+        """
+        called before modifying the db, in multi writer mode the write lock is
+        acquired when the transaction starts (instead of with the first write
+        which could fail with 'database is locked' after earlier statements of
+        the transaction succeeded)
+
+        sqlite waits up to busy_timeout for the lock, if it still fails with
+        'database is locked' it is retried until busy_timeout has passed
+        """
+        if (not self._multi_writer) or self._db_root()._write_tx:
+            return
+        deadline = time.monotonic() + self._busy_timeout
+        i = 0
+        while True:
+            try:
+                self.db.conn.select_one("BEGIN IMMEDIATE")
+                break
+            except sqlite3.OperationalError as e:
+                if ("locked" not in str(e)) or (time.monotonic() > deadline):
+                    raise
+            time.sleep(random.random() * min(1, 0.01 * 2**i))
+            i += 1
+        self._db_root()._write_tx = True
+        self._dirty = True
+
+    def _finish(self, commit, db=True):
+        """
+        commit or rollback the pending changes of this instance and of all sub-data
+        enlisted in the current transaction
+
+        if db is False, only the file operations are finalized (the db connection is
+        shared with the parent which commits or rolls back)
+        """
+        children = list(self._tx_children.values())
+        self._tx_children = {}
+        for child in children:
+            child._tx_parent = None
+            child._tx_depth -= 1
+            if child._tx_depth == 0:
+                child._finish(commit, db=(child.db is not self.db))
+            if not child._open:
+                child._open = True
+                child.close()
+
+        if commit:
+            if self._dirty and db:
+                self._db_commit()
+            callbacks = self._tx_on_commit
+        else:
+            if self._dirty and db:
+                if self.verbose > 1:
+                    print(
+                        "rollback               {} in {}".format(
+                            self._name, self._dirname
+                        )
+                    )
+                try:
+                    self.db.conn.select_one("ROLLBACK")
+                except sqlite3.OperationalError:
+                    # no transaction active
+                    pass
+                self._db_root()._write_tx = False
+            callbacks = self._tx_on_rollback[::-1]
+            self._cache_invalidate()
+
+        self._tx_on_commit = []
+        self._tx_on_rollback = []
+        self._dirty = False
+        for f in callbacks:
+            f()
+
+    def _sub_pds(self, v):
+        """
+        return the PersistentDataStructure for the sub-data marker v as stored in the db
+
+        within a transaction the sub-data is enlisted in the transaction and the same
+        instance is returned for repeated requests
+        """
+        ident = v["node"] if "node" in v else v["name"]
+        if self._tx_depth > 0:
+            try:
+                sub_data = self._tx_children[ident]
+            except KeyError:
+                pass
+            else:
+                sub_data._open = True
+                return sub_data
+
+        if self._pool_size > 0:
+            sub_data = self._pooled_sub_pds(v, ident)
+        else:
+            sub_data = self._new_sub_pds(v)
+        if self._tx_depth > 0:
+            sub_data._tx_parent = self
+            sub_data._tx_depth += 1
+            self._tx_children[ident] = sub_data
+        return sub_data
+
+    def _new_sub_pds(self, v):
+        if "node" in v:
+            return self._node_pds(v["node"])
+        return self.__class__(
+            name=v["name"],
+            path=os.path.join(self._dirname),
+            single_file=self._single_file,
+            **self._sub_options()
+        )
+
+    def _pooled_sub_pds(self, v, ident):
+        """
+        return the handle for the sub-data from the pool of the root (or open and
+        add a new one) and increase its reference count
+        """
+        pool_root = self if self._pool_root is None else self._pool_root
+        pool_key = (self._dirname, ident)
+        sub_data = pool_root._pool.get(pool_key)
+        if (sub_data is None) or (sub_data.is_closed() and not sub_data._lazy):
+            sub_data = self._new_sub_pds(v)
+            sub_data._pool_root = pool_root
+            sub_data._pool_key = pool_key
+            pool_root._pool[pool_key] = sub_data
+        sub_data._pool_refs += 1
+        pool_root._pool.move_to_end(pool_key)
+        pool_root._pool_evict()
+        return sub_data
+
+    def _pool_evict(self):
+        """
+        close the least recently used handles of the pool which are not in use,
+        such that at most pool_size of them stay open
+        """
+        idle = [k for k, sub_data in self._pool.items() if sub_data._pool_refs == 0]
+        for k in idle[: max(0, len(idle) - self._pool_size)]:
+            sub_data = self._pool.pop(k)
+            sub_data._pool_root = None
+            sub_data.close()
+
+    def _pool_detach(self):
+        """
+        remove this handle from the pool (e.g. because it gets erased)
+        """
+        if self._pool_root is not None:
+            self._pool_root._pool.pop(self._pool_key, None)
+            self._pool_root = None
+
+    def _erase_sub(self, v):
+        with self._sub_pds(v) as sub_data:
+            sub_data.erase()
+
+    def _defer_remove(self, t, v):
+        """
+        remove the sub-data or the array file a value refers to, once the
+        deletion of the value has been committed
+        """
+        if t == TYPE_SUB:
+            self._tx_on_commit.append(partial(self._erase_sub, v))
+        elif t == TYPE_NPA:
+            self._tx_on_commit.append(partial(self._remove_npa, v))
+
+    def _remove_npa(self, v):
+        """
+        remove the file(s) of the array marker v (if the array is not stored inline)
+        """
+        if "fname" in v:
+            self._remove_file(v["fname"])
+        for fname in v.get("chunks", []):
+            self._remove_file(fname)
+
+    def _remove_file(self, fname):
+        try:
+            os.remove(os.path.join(self._dirname, fname))
+        except FileNotFoundError:
+            pass
+
+    def erase(self, fast=False, background=False, workers=1):
         """
         removed the database file from the disk
 
         this is called recursively for all sub PersistentDataStructure
+
+        With fast=True the directory of the PDS is removed as a whole (all sub-data
+        and arrays are stored within it) without reading the db, see also clear().
+        With background=True the directory is renamed and removed by a thread,
+        which is returned. The sub-directories are removed by workers threads.
+        Handles of the sub-data become invalid. Sub-data of a single file store is
+        always erased node by node.
         """
+        self._need_writable()
+        self._check_fork()
         if self.verbose > 1:
             print("erase db               {} in {}".format(self._name, self._dirname))
 
         if self.is_closed():
-            self.open()
+            if self._lazy:
+                self._open_lazy()
+            else:
+                self.open()
+        self._pool_detach()
+
+        if fast and (self._root is None):
+            self._close_pooled()
+            self.close()
+            dirname = self._dirname
+            if background:
+                dirname = "{}.erase-{}".format(self._dirname, rand_str(self._l))
+                os.rename(self._dirname, dirname)
+                return self._remove_thread(dirname, workers)
+            _remove_tree(dirname, workers)
+            return
+
+        if self._root is not None:
+            try:
+                self._erase_node()
+            finally:
+                self.close()
+            return
 
         try:
-            for key in self:
-                t, v = self.get_value_and_value_type(key)
+            if self._single_file:
+                # the nodes are removed with the file, only their arrays need care
+                for vtype, raw in list(
+                    self.db.conn.select(
+                        'SELECT vtype, value FROM "%s" WHERE vtype IS NOT ?'
+                        % SUBDATA_TABLE,
+                        (TYPE_ORD,),
+                    )
+                ):
+                    t, v = self._decode_typed(vtype, raw)
+                    if t == TYPE_NPA:
+                        self._remove_npa(v)
+            for key, t, v in list(self._iter_markers()):
                 if t == TYPE_SUB:
-                    with self.getData(key) as sub_data:
-                        sub_data.erase()
+                    if "node" not in v:
+                        with self._sub_pds(v) as sub_data:
+                            sub_data.erase()
                 elif t == TYPE_NPA:
-                    os.remove(os.path.join(self._dirname, v["fname"]))
+                    self._remove_npa(v)
         except:
             traceback.print_exc()
         finally:
@@ -197,21 +1420,126 @@ class PersistentDataStructure(object):
             if self.verbose > 0:
                 warnings.warn("directory structure can not be deleted\n{}".format(e))
 
-    def clear(self):
+    def _erase_node(self):
+        """
+        remove this node and all its sub-nodes (including their arrays) from the
+        single file store
+        """
+        sub_nodes = (
+            "WITH RECURSIVE sub(id) AS (VALUES (?) UNION ALL "
+            'SELECT n.id FROM "{}" AS n JOIN sub ON n.parent = sub.id) '
+            "SELECT id FROM sub"
+        ).format(SUBDATA_NODES_TABLE)
+        self._begin_write()
+        rows = list(
+            self.db.conn.select(
+                'SELECT vtype, value FROM "{}" WHERE node IN ({}) AND vtype IS NOT ?'.format(
+                    SUBDATA_TABLE, sub_nodes
+                ),
+                (self._node, TYPE_ORD),
+            )
+        )
+        self.db.conn.execute(
+            'DELETE FROM "{}" WHERE node IN ({})'.format(SUBDATA_TABLE, sub_nodes),
+            (self._node,),
+        )
+        self.db.conn.execute(
+            'DELETE FROM "{}" WHERE id IN ({})'.format(SUBDATA_NODES_TABLE, sub_nodes),
+            (self._node,),
+        )
+        self._commit()
+        for vtype, raw in rows:
+            t, v = self._decode_typed(vtype, raw)
+            if t == TYPE_NPA:
+                self._remove_npa(v)
+
+    @_write_operation
+    def clear(self, fast=False, background=False, workers=1):
         """
         delete all entries from the db
+
+        With fast=True the sub-data and arrays are not removed one by one, instead
+        all files and directories in the directory of the PDS (except for its
+        sqlite file) are moved to a new directory, which is removed once the
+        deletion of the entries has been committed (and moved back on rollback).
+        With background=True that directory is removed by a thread (see erase). This must not be used while other
+        processes write to the store (multi_writer). Handles of the sub-data
+        become invalid. For sub-data of a single file store fast is ignored.
         """
         self.need_open()
 
-        for key in self:
-            t, v = self.get_value_and_value_type(key)
-            if t == TYPE_SUB:
-                with self.getData(key) as sub_data:
-                    sub_data.erase()
-            elif t == TYPE_NPA:
-                os.remove(os.path.join(self._dirname, v["fname"]))
+        if fast and (self._root is None):
+            self._close_pooled()
+            if self._single_file:
+                for tab in (SUBDATA_TABLE, SUBDATA_NODES_TABLE):
+                    self.db.conn.execute('DELETE FROM "%s"' % tab)
+            trash = self._move_entries()
+            self._tx_on_commit.append(
+                partial(self._remove_trash, trash, background, workers)
+            )
+            self._tx_on_rollback.append(partial(self._restore_entries, trash))
+        else:
+            for key, t, v in self._iter_markers():
+                self._defer_remove(t, v)
 
-        self.db.clear()
+        self.db.conn.execute(
+            self._q("DELETE FROM {tab} WHERE {node}1"), self._node_args
+        )
+        self._cache_invalidate()
+        self._commit()
+
+    def _move_entries(self):
+        """
+        move all files and directories in the directory of this PDS except for its
+        sqlite file to a new directory (see clear) and return its path
+        """
+        keep = [
+            self._name + end for end in (".db", ".db-wal", ".db-shm", ".db-journal")
+        ]
+        trash = join(self._dirname, "__" + self._new_rand_file_name(make_dir=True))
+        for fname in os.listdir(self._dirname):
+            path = join(self._dirname, fname)
+            if (fname not in keep) and (path != trash):
+                os.rename(path, join(trash, fname))
+        return trash
+
+    def _restore_entries(self, trash):
+        """
+        move the entries back from the directory trash (see _move_entries)
+        """
+        for fname in os.listdir(trash):
+            os.rename(join(trash, fname), join(self._dirname, fname))
+        os.rmdir(trash)
+
+    def _remove_trash(self, trash, background, workers):
+        if background:
+            self._remove_thread(trash, workers)
+        else:
+            _remove_tree(trash, workers)
+
+    def _remove_thread(self, path, workers):
+        """
+        start and return a thread which removes the directory path
+        """
+        thread = threading.Thread(
+            target=_remove_tree, args=(path, workers), name="pds-remove"
+        )
+        thread.start()
+        if self.verbose > 1:
+            print("remove {} in background".format(path))
+        return thread
+
+    def _close_pooled(self):
+        """
+        close the pooled handles of the sub-data of this PDS (and of their sub-data)
+        """
+        pool_root = self if self._pool_root is None else self._pool_root
+        prefix = self._dirname + os.sep
+        for k in list(pool_root._pool):
+            if (k[0] + os.sep).startswith(prefix):
+                sub_data = pool_root._pool.pop(k)
+                sub_data._pool_root = None
+                sub_data.close()
 
     def show_stat(self, recursive=False, prepend=""):
         prepend += self._name
@@ -229,7 +1557,7 @@ class PersistentDataStructure(object):
         npa_c = 0
         err_c = 0
 
-        sub_data_keys = set()
+        sub_data_keys = []
 
         for k in self:
             if isinstance(k, str):
@@ -239,12 +1567,12 @@ class PersistentDataStructure(object):
             else:
                 oth_key += 1
 
-            t, v = self.get_value_and_value_type(k)
+        for k, t, v in self._iter_markers():
             if t == TYPE_NPA:
                 npa_c += 1
             elif t == TYPE_SUB:
                 sub_c += 1
-                sub_data_keys.add(k)
+                sub_data_keys.append((k, v))
             elif t == TYPE_LOAD_ERR:
                 err_c += 1
 
@@ -258,10 +1586,10 @@ class PersistentDataStructure(object):
         print()
         sys.stdout.flush()
         if recursive:
-            for k in sub_data_keys:
+            for k, v in sub_data_keys:
                 print("show stat for subdata with key {}".format(key_to_str(k)))
                 sys.stdout.flush()
-                with self.getData(k) as subdata:
+                with self._sub_pds(v) as subdata:
                     subdata.show_stat(recursive=recursive, prepend=prepend + "->")
 
     def __is_sub_data(self, value):
@@ -286,41 +1614,461 @@ class PersistentDataStructure(object):
         this is considered the case if the value itself has an index 'magic'
         whose value matches a magic sign defined by MAGIC_SIGN_NPARRAY
         """
-        try:
-            assert value["magic"] == MAGIC_SIGN_NPARRAY
-            return True
-        except:
-            return False
+        try:
+            assert value["magic"] == MAGIC_SIGN_NPARRAY
+            return True
+        except:
+            return False
+
+    def has_key(self, key):
+        return key in self
+
+    def is_subdata(self, key):
+        try:
+            return self.get_value_type(key) == TYPE_SUB
+        except KeyError:
+            return False
+
+    def is_NPA(self, key):
+        try:
+            return self.get_value_type(key) == TYPE_NPA
+        except KeyError:
+            return False
+
+    def iter_subdata(self, with_marker=False):
+        """
+        iterate over the keys of all sub-data (in the order of insertion)
+
+        if with_marker is True, (key, marker) pairs are yielded, the marker dict
+        holds the name of the directory ("name") or the id of the node ("node")
+
+        only the markers are read from the db, no ordinary value is loaded
+        """
+        return self._iter_type(TYPE_SUB, with_marker)
+
+    def iter_arrays(self, with_marker=False):
+        """
+        iterate over the keys of all numpy arrays (in the order of insertion)
+
+        if with_marker is True, (key, marker) pairs are yielded, the marker dict
+        holds the file name ("fname"), the chunk files ("chunks") or, for inline
+        arrays, the data itself
+        """
+        return self._iter_type(TYPE_NPA, with_marker)
+
+    def iter_ordinary(self):
+        """
+        iterate over the keys of all ordinary values (in the order of insertion)
+        without loading the values
+        """
+        return self._iter_type(TYPE_ORD, False)
+
+    def _iter_type(self, t, with_marker):
+        self.need_open()
+        # rows without type (vtype is NULL) need to be classified by their value
+        rows = self.db.conn.select(
+            self._q(
+                "SELECT key, vtype, CASE WHEN vtype IS NOT ? THEN value END FROM {tab} "
+                "WHERE {node}(vtype = ? OR vtype IS NULL) ORDER BY rowid"
+            ),
+            (TYPE_ORD,) + self._node_args + (t,),
+        )
+        for key, vtype, raw in rows:
+            if vtype is None:
+                vtype, v = self._decode_value_and_value_type(raw)
+                if vtype != t:
+                    continue
+            elif with_marker:
+                v = self._decode_typed(vtype, raw)[1]
+            if with_marker:
+                yield key, v
+            else:
+                yield key
+
+    def keys(
+        self, prefix=None, start=None, stop=None, limit=None, offset=0, fetch_size=None
+    ):
+        """
+        iterate over the keys in key order, optionally restricted to the keys
+        starting with prefix and / or to the range start <= key < stop
+
+        limit and offset select a page of the result (as LIMIT / OFFSET in SQL).
+        The scan uses the index of the key column, the order is the one of sqlite:
+        str keys by code point, followed by bytes keys. Note that other keys (e.g.
+        int) are stored as str, i.e., they are ordered as their str representation.
+
+        The rows are fetched in chunks of fetch_size (default FETCH_SIZE) rows, so
+        the memory needed does not depend on the size of the PDS.
+        """
+        for r in self._scan("key", prefix, start, stop, limit, offset, fetch_size):
+            yield r[0]
+
+    def items(
+        self,
+        prefix=None,
+        start=None,
+        stop=None,
+        limit=None,
+        offset=0,
+        fetch_size=None,
+        mmap_mode=_NO_DEFAULT,
+    ):
+        """
+        iterate over the (key, value) pairs in key order, for the arguments see keys()
+
+        Each value is decoded when its pair is yielded. As with getData, sub-data is
+        returned as open PersistentDataStructure and arrays are loaded with mmap_mode.
+        """
+        rows = self._scan(
+            "key, vtype, value", prefix, start, stop, limit, offset, fetch_size
+        )
+        for key, vtype, raw in rows:
+            yield key, self._resolve(*self._decode_typed(vtype, raw), mmap_mode)
+
+    def values(
+        self,
+        prefix=None,
+        start=None,
+        stop=None,
+        limit=None,
+        offset=0,
+        fetch_size=None,
+        mmap_mode=_NO_DEFAULT,
+    ):
+        """
+        iterate over the values in key order, see items()
+        """
+        for key, v in self.items(
+            prefix, start, stop, limit, offset, fetch_size, mmap_mode
+        ):
+            yield v
+
+    def _scan(self, columns, prefix, start, stop, limit, offset, fetch_size):
+        """
+        yield the rows (key first) in key order restricted as described in keys()
+
+        Each query fetches at most fetch_size rows, the next chunk starts after the
+        last key of the previous one (using the index, no OFFSET).
+        """
+        self.need_open()
+        if fetch_size is None:
+            fetch_size = FETCH_SIZE
+        cond, args = self._key_range(prefix, start, stop)
+        query = self._q(
+            "SELECT " + columns + " FROM {tab} WHERE {node}" + cond + "{{after}} "
+            "ORDER BY key LIMIT ? OFFSET ?"
+        )
+        after = ()
+        while (limit is None) or (limit > 0):
+            n = fetch_size if limit is None else min(fetch_size, limit)
+            rows = list(
+                self.db.conn.select(
+                    query.format(after=" AND key > ?" if after else ""),
+                    self._node_args + args + after + (n, offset),
+                )
+            )
+            yield from rows
+            if len(rows) < n:
+                return
+            if limit is not None:
+                limit -= n
+            after = (rows[-1][0],)
+            offset = 0
+
+    def _resolve(self, t, v, mmap_mode=_NO_DEFAULT):
+        """
+        return the value as returned by getData for the decoded (type, value)
+        """
+        if t == TYPE_SUB:
+            return self._sub_pds(v)
+        elif t == TYPE_NPA:
+            return self._loadNPA(v, mmap_mode)
+        elif t == TYPE_LOAD_ERR:
+            raise v
+        return v
+
+    @staticmethod
+    def _key_range(prefix, start, stop):
+        """
+        return the SQL condition and its arguments restricting the key to the
+        prefix and the range [start, stop)
+        """
+        cond = ["1"]
+        args = []
+        if prefix is not None:
+            cond.append("key >= ?")
+            args.append(prefix)
+            upper = _prefix_upper_bound(prefix)
+            if upper is not None:
+                cond.append("key < ?")
+                args.append(upper)
+            elif isinstance(prefix, str):
+                # all str keys are less than the bytes keys
+                cond.append("typeof(key) = 'text'")
+        if start is not None:
+            cond.append("key >= ?")
+            args.append(start)
+        if stop is not None:
+            cond.append("key < ?")
+            args.append(stop)
+        return " AND ".join(cond), tuple(args)
+
+    def get_value_type(self, key):
+        """
+        return the type of the value (TYPE_ORD, TYPE_SUB, TYPE_NPA or TYPE_LOAD_ERR)
+        without loading ordinary values
+
+        raises KeyError if the key is not found
+        """
+        self.need_open()
+        row = self._get_raw(key, load_ordinary=False)
+        if row is None:
+            raise KeyError(key)
+        return self._decode_typed(*row)[0]
+
+    def get_value_and_value_type(self, key):
+        self.need_open()
+        row = self._get_raw(key)
+        if row is None:
+            return self._load_error(KeyError(key))
+        return self._decode_typed(*row)
+
+    def _load_error(self, e):
+        log.warning(
+            "could not load data (may NOT cause trouble) due to {} {}".format(
+                type(e), e
+            )
+        )
+        log.info(traceback.format_exc())
+        return TYPE_LOAD_ERR, e
+
+    def _decode_value_and_value_type(self, raw):
+        try:
+            v = self._decode(raw)
+        except Exception as e:
+            return self._load_error(e)
+        return self._value_type(v)
+
+    def _decode_typed(self, vtype, raw):
+        """
+        return (type, value) for a row, the value is only classified by its magic
+        sign if the type is unknown (rows written without type)
+        """
+        if vtype == TYPE_ORD:
+            if raw is None:
+                # value not loaded
+                return TYPE_ORD, None
+            try:
+                return TYPE_ORD, self._decode(raw)
+            except Exception as e:
+                return self._load_error(e)
+        return self._decode_value_and_value_type(raw)
+
+    def _encode(self, value, vtype=TYPE_ORD):
+        """
+        serialize the value and compress it if compression is set and the
+        compressed data is smaller
+
+        ordinary values are serialized with the serializer of this PDS, all other
+        values (the markers of sub-data and arrays) are pickled by the sqlitedict
+        """
+        if (self._serializer is None) or (vtype != TYPE_ORD):
+            raw = self.db.encode(value)
+        else:
+            dumps = SERIALIZERS[self._serializer][0]
+            raw = (
+                SERIALIZED_SIGN
+                + self._serializer.encode("ascii")
+                + b"\x00"
+                + dumps(value)
+            )
+        if self._compression is None:
+            return raw
+        data = self._compress(bytes(raw))
+        if len(data) >= len(raw):
+            return raw
+        return sqlite3.Binary(data)
+
+    def _decode(self, raw):
+        """
+        inverse of _encode, the codec is read from the value
+        """
+        if bytes(raw[: len(COMPRESSED_SIGN)]) == COMPRESSED_SIGN:
+            raw = self._decompress(bytes(raw))
+        if bytes(raw[: len(SERIALIZED_SIGN)]) == SERIALIZED_SIGN:
+            name, data = self._split_name(raw, SERIALIZED_SIGN)
+            if name not in SERIALIZERS:
+                raise ValueError("unknown serializer {!r}".format(name))
+            return SERIALIZERS[name][1](data)
+        return self.db.decode(raw)
+
+    @staticmethod
+    def _split_name(data, sign):
+        """
+        split sign + name + zero byte + data into name and data (without copying)
+        """
+        data = memoryview(data)
+        i = bytes(data[: len(sign) + 256]).index(b"\x00", len(sign))
+        return bytes(data[len(sign) : i]).decode("ascii"), data[i + 1 :]
+
+    def _compress(self, data):
+        """
+        compress the bytes with the codec of this PDS and prepend the codec name
+        """
+        compress = CODECS[self._compression][0]
+        return (
+            COMPRESSED_SIGN
+            + self._compression.encode("ascii")
+            + b"\x00"
+            + compress(data, self._compression_level)
+        )
+
+    @staticmethod
+    def _decompress(data):
+        name, data = PersistentDataStructure._split_name(data, COMPRESSED_SIGN)
+        if name not in CODECS:
+            raise ValueError("unknown compression codec {!r}".format(name))
+        return CODECS[name][1](data)
+
+    def _value_type(self, v):
+        if self.__is_nparray(v):
+            return TYPE_NPA, v
+        elif self.__is_sub_data(v):
+            return TYPE_SUB, v
+        else:
+            return TYPE_ORD, v
+
+    def _get_raw(self, key, load_ordinary=True):
+        """
+        return (vtype, raw value) for the key, or None if the key is not found
+
+        if load_ordinary is False, the raw value of ordinary values is not read
+        from the db (raw value is None)
+        """
+        return self.db.conn.select_one(
+            self._q(
+                "SELECT vtype, CASE WHEN ? OR vtype IS NOT ? THEN value END "
+                "FROM {tab} WHERE {node}key = ?"
+            ),
+            (load_ordinary, TYPE_ORD) + self._node_args + (key,),
+        )
+
+    def _fetch_raw(self, keys, load_ordinary=True):
+        """
+        yield (index, vtype, raw value) for all keys found in the db
+
+        The keys are queried in chunks of SQL_CHUNK_SIZE, the index refers to
+        the position of the key in the sequence 'keys'. The raw value still needs
+        to be decoded (see _decode_typed).
+        """
+        self.need_open()
+        for offset in range(0, len(keys), SQL_CHUNK_SIZE):
+            chunk = keys[offset : offset + SQL_CHUNK_SIZE]
+            query = self._q(
+                "WITH q(i, k) AS (VALUES " + ",".join(["(?,?)"] * len(chunk)) + ") "
+                "SELECT q.i, t.vtype, CASE WHEN ? OR t.vtype IS NOT ? THEN t.value END "
+                "FROM q JOIN {tab} AS t ON t.key = q.k WHERE {node}1"
+            )
+            args = []
+            for i, k in enumerate(chunk):
+                args += [offset + i, k]
+            args += [load_ordinary, TYPE_ORD]
+            args += self._node_args
+            yield from self.db.conn.select(query, args)
+
+    def _iter_markers(self):
+        """
+        yield (key, type, value) for all sub-data and array entries (and for entries
+        which can not be loaded) without loading any ordinary value
+        """
+        self.need_open()
+        rows = self.db.conn.select(
+            self._q("SELECT key, vtype, value FROM {tab} WHERE {node}vtype IS NOT ?"),
+            self._node_args + (TYPE_ORD,),
+        )
+        for key, vtype, raw in rows:
+            t, v = self._decode_typed(vtype, raw)
+            if t != TYPE_ORD:
+                yield key, t, v
+
+    def _put(self, key, value, vtype):
+        """
+        write the value (encoded by _encode) together with its type
+        """
+        self._put_raw(key, self._encode(value, vtype), vtype)
 
-    def has_key(self, key):
-        self.need_open()
-        return key in self.db
+    def _put_raw(self, key, raw, vtype):
+        self._cache_invalidate(key)
+        self._begin_write()
+        self.db.conn.execute(self._insert_query(), self._node_args + (key, raw, vtype))
 
-    def is_subdata(self, key):
-        return (key in self) and self.__is_sub_data(self.db[key])
+    def cache_info(self):
+        """
+        return the statistics of the read cache (see cache_bytes)
+        """
+        return dict(
+            hits=self._cache_hits,
+            misses=self._cache_misses,
+            entries=len(self._cache),
+            bytes=self._cache_size,
+            max_bytes=self._cache_bytes,
+        )
 
-    def is_NPA(self, key):
-        return (key in self) and self.__is_nparray(self.db[key])
+    def _cache_get(self, key):
+        """
+        return the cached value for the key, or _NO_DEFAULT
 
-    def get_value_and_value_type(self, key):
+        only str and bytes keys are cached, other keys may refer to the same row
+        with a different python value (e.g. 1 and "1")
+        """
+        if (self._cache_bytes <= 0) or not isinstance(key, (str, bytes)):
+            return _NO_DEFAULT
         try:
-            v = self.db[key]
-        except Exception as e:
-            log.warning(
-                "could not load data (may NOT cause trouble) due to {} {}".format(
-                    type(e), e
-                )
+            v, size = self._cache[key]
+        except KeyError:
+            self._cache_misses += 1
+            return _NO_DEFAULT
+        self._cache.move_to_end(key)
+        self._cache_hits += 1
+        return v
+
+    def _cache_put(self, key, v, size):
+        if (size > self._cache_bytes) or not isinstance(key, (str, bytes)):
+            return
+        self._cache_invalidate(key)
+        self._cache[key] = (v, size)
+        self._cache_size += size
+        while self._cache_size > self._cache_bytes:
+            _, (_, s) = self._cache.popitem(last=False)
+            self._cache_size -= s
+
+    def _cache_invalidate(self, key=None):
+        """
+        remove the key from the cache, or all keys if key is None or not cacheable
+        """
+        if not self._cache:
+            return
+        if (key is None) or not isinstance(key, (str, bytes)):
+            self._cache.clear()
+            self._cache_size = 0
+            return
+        item = self._cache.pop(key, None)
+        if item is not None:
+            self._cache_size -= item[1]
+
+    def _insert_query(self):
+        """
+        query to insert (key, raw value, vtype), preceded by self._node_args
+        """
+        if self._root is None:
+            return "REPLACE INTO {} (key, value, vtype) VALUES (?,?,?)".format(
+                self._tab
             )
-            log.info(traceback.format_exc())
-            return TYPE_LOAD_ERR, e
-
-        if self.__is_nparray(v):
-            return TYPE_NPA, v
-        elif self.__is_sub_data(v):
-            return TYPE_SUB, v
-        else:
-            return TYPE_ORD, v
+        return "REPLACE INTO {} (node, key, value, vtype) VALUES (?,?,?,?)".format(
+            self._tab
+        )
 
+    @_write_operation
     def setData(self, key, value, overwrite=False):
         """
         write the key value pair to the data base
@@ -331,49 +2079,276 @@ class PersistentDataStructure(object):
         """
         self.need_open()
 
-        if (overwrite) and (key in self.db):
+        row = self._get_raw(key, load_ordinary=False)
+        if row is not None:
+            if not overwrite:
+                raise KeyError("could not set data, key exists, and overwrite is False")
             if self.verbose > 1:
-                print("overwrite True: del key")
-            self.__delitem__(key)
+                print("overwrite True: remove old value")
 
-        if not key in self.db:
-            if _NP and isinstance(value, np.ndarray):
-                if self.verbose > 1:
-                    print("set nparray")
-                return self._setNPA(key, nparray=value)
-            else:
-                if self.verbose > 1:
-                    print("set normal value")
-                self.db[key] = value
-                self.db.commit()
-                return True
+        if _NP and isinstance(value, np.ndarray):
+            if self.verbose > 1:
+                print("set nparray")
+            self._setNPA(key, nparray=value)
         else:
-            if overwrite:
-                raise RuntimeError("this can not happen -> if so, pls check code!")
-            raise KeyError("could not set data, key exists, and overwrite is False")
+            if self.verbose > 1:
+                print("set normal value")
+            self._put(key, value, TYPE_ORD)
+            self._commit()
+        # only once the new value has been written
+        if row is not None:
+            self._defer_remove(*self._decode_typed(*row))
+        return True
 
-    def _setNPA(self, key, nparray):
-        d = {"fname": self._new_rand_file_name(end=".npy"), "magic": MAGIC_SIGN_NPARRAY}
+    @_write_operation
+    def set_many(self, items, overwrite=False):
+        """
+        write many key value pairs at once
+
+        items is a mapping or an iterable of (key, value) pairs.
+        All values are written within a single transaction. As with setData,
+        if any of the keys already exists overwrite must be set True, otherwise
+        a KeyError is raised and nothing is written.
+
+        returns the number of values written
+        """
+        self.need_open()
+        try:
+            items = items.items()
+        except AttributeError:
+            pass
+        items = dict(items)
+        keys = list(items)
+
+        existing = {
+            keys[i]: (vtype, raw)
+            for i, vtype, raw in self._fetch_raw(keys, load_ordinary=False)
+        }
+        if existing and not overwrite:
+            raise KeyError(
+                "could not set data, {} key(s) exist (e.g. {}), and overwrite is False".format(
+                    len(existing), key_to_str(next(iter(existing)))
+                )
+            )
+
+        with self.transaction():
+            rows = []
+            for key, value in items.items():
+                if isinstance(value, self.__class__):
+                    self.setDataFromSubData(key, value, overwrite=overwrite)
+                    continue
+                if key in existing:
+                    self._defer_remove(*self._decode_typed(*existing[key]))
+                if _NP and isinstance(value, np.ndarray):
+                    value = self._saveNPA(key, value)
+                    vtype = TYPE_NPA
+                else:
+                    vtype = TYPE_ORD
+                self._cache_invalidate(key)
+                rows.append(self._node_args + (key, self._encode(value, vtype), vtype))
+
+            self.db.conn.executemany(self._insert_query(), rows)
+            self._commit()
+        return len(items)
+
+    def update(self, items=(), **kwargs):
+        """
+        like dict.update, existing keys are overwritten (see set_many)
+        """
+        self.set_many(items, overwrite=True)
+        if kwargs:
+            self.set_many(kwargs, overwrite=True)
+
+    def _saveNPA(self, key, nparray):
+        """
+        save the array to a new file and return the dict to be stored in the db
+
+        arrays smaller than npa_inline_threshold bytes are not saved to a file,
+        dtype, shape and the raw data are stored in the dict instead
+        """
+        if (nparray.nbytes < self._npa_inline_threshold) and (
+            not nparray.dtype.hasobject
+        ):
+            if self.verbose > 1:
+                print("set NPA (key)", key, " inline")
+            return {
+                "dtype": np.lib.format.dtype_to_descr(nparray.dtype),
+                "shape": nparray.shape,
+                "data": np.ascontiguousarray(nparray).tobytes(),
+                "magic": MAGIC_SIGN_NPARRAY,
+            }
+
+        if self._compression is not None:
+            end = ".npy." + self._compression
+        else:
+            end = ".npy"
+        d = {"fname": self._new_rand_file_name(end=end), "magic": MAGIC_SIGN_NPARRAY}
         if self.verbose > 1:
             print("set NPA (key)", key, " (fname)", d["fname"])
-        self.db[key] = d
-        self.db.commit()
-
         full_name = os.path.join(self._dirname, d["fname"])
-        np.save(full_name, nparray)
+        if self._compression is None:
+            np.save(full_name, nparray)
+        else:
+            # the file holds the compressed .npy data
+            buf = io.BytesIO()
+            np.save(buf, nparray)
+            with open(full_name, "wb") as f:
+                f.write(self._compress(buf.getvalue()))
+            d["codec"] = self._compression
+        self._tx_on_rollback.append(partial(self._remove_file, d["fname"]))
+        return d
+
+    def _setNPA(self, key, nparray):
+        self._put(key, self._saveNPA(key, nparray), TYPE_NPA)
+        self._commit()
         return True
 
-    def _loadNPA(self, fname):
-        return np.load(os.path.join(self._dirname, fname))
+    def _loadNPA(self, v, mmap_mode=_NO_DEFAULT):
+        """
+        load the array for the marker v as stored in the db
+
+        inline arrays are always returned as ordinary arrays (no memory mapping),
+        chunked arrays (see append_array) are memory mapped only if they consist
+        of a single chunk, otherwise the chunks are concatenated
+        """
+        if "data" in v:
+            dtype = np.lib.format.descr_to_dtype(v["dtype"])
+            return np.frombuffer(v["data"], dtype=dtype).reshape(v["shape"]).copy()
+        if mmap_mode is _NO_DEFAULT:
+            mmap_mode = self._mmap_mode
+        if "chunks" in v:
+            return self._load_chunks(v, mmap_mode)
+        if "codec" in v:
+            # compressed file, can not be memory mapped
+            with open(os.path.join(self._dirname, v["fname"]), "rb") as f:
+                return np.load(io.BytesIO(self._decompress(f.read())))
+        return np.load(os.path.join(self._dirname, v["fname"]), mmap_mode=mmap_mode)
+
+    def _load_chunks(self, v, mmap_mode):
+        length = v["length"]
+        if len(v["chunks"]) == 0:
+            dtype = np.lib.format.descr_to_dtype(v["dtype"])
+            return np.empty((0,) + tuple(v["shape"]), dtype=dtype)
+        if (mmap_mode is not None) and (len(v["chunks"]) == 1):
+            a = np.load(join(self._dirname, v["chunks"][0]), mmap_mode=mmap_mode)
+            return a[:length]
+
+        parts = []
+        for fname in v["chunks"]:
+            # read only the used rows of the chunks
+            a = np.load(join(self._dirname, fname), mmap_mode="r")
+            parts.append(a[: min(length, len(a))])
+            length -= len(parts[-1])
+        return np.concatenate(parts)
+
+    @_write_operation
+    def append_array(self, key, rows, chunk_rows=None):
+        """
+        append rows (along the first axis) to the array stored for the key
+
+        If the key does not exist, a new array is created. The data is stored in
+        chunk files with a fixed number of rows (chunk_rows, by default such that a
+        chunk has about APPEND_CHUNK_BYTES bytes), so appending only writes the new
+        rows instead of rewriting the whole array. An array stored by setData is
+        converted to the chunked layout with the first append.
+
+        getData returns the concatenated array (see _loadNPA).
+        """
+        self.need_open()
+        rows = np.asarray(rows)
+        if rows.ndim == 0:
+            raise ValueError("rows must be at least one dimensional")
+
+        row = self._get_raw(key, load_ordinary=False)
+        if row is None:
+            v = None
+            t = None
+        else:
+            t, v = self._decode_typed(*row)
+            if t != TYPE_NPA:
+                raise TypeError(
+                    "can not append to value of type {} (key {})".format(
+                        t, key_to_str(key)
+                    )
+                )
+
+        if (v is None) or ("chunks" not in v):
+            if v is None:
+                dtype = rows.dtype
+                shape = rows.shape[1:]
+            else:
+                old = self._loadNPA(v, mmap_mode="r")
+                dtype = old.dtype
+                shape = old.shape[1:]
+            if chunk_rows is None:
+                row_bytes = dtype.itemsize * int(np.prod(shape, dtype=int))
+                chunk_rows = max(1, APPEND_CHUNK_BYTES // max(1, row_bytes))
+            d = {
+                "dtype": np.lib.format.dtype_to_descr(dtype),
+                "shape": shape,
+                "chunk_rows": chunk_rows,
+                "length": 0,
+                "chunks": [],
+                "magic": MAGIC_SIGN_NPARRAY,
+            }
+            if v is not None:
+                self._write_rows(d, old)
+                self._tx_on_commit.append(partial(self._remove_npa, v))
+            v = d
+        else:
+            v = dict(v, chunks=list(v["chunks"]))
+
+        dtype = np.lib.format.descr_to_dtype(v["dtype"])
+        if rows.shape[1:] != tuple(v["shape"]):
+            raise ValueError(
+                "shape of rows {} does not match the shape of the array {}".format(
+                    rows.shape[1:], tuple(v["shape"])
+                )
+            )
+        self._write_rows(v, rows.astype(dtype, copy=False))
+        self._put(key, v, TYPE_NPA)
+        self._commit()
+        return v["length"]
+
+    def _write_rows(self, v, rows):
+        """
+        write the rows to the chunk files of the chunked array marker v (updated in place)
+        """
+        dtype = np.lib.format.descr_to_dtype(v["dtype"])
+        chunk_rows = v["chunk_rows"]
+        i = 0
+        while i < len(rows):
+            offset = v["length"] % chunk_rows
+            if offset == 0:
+                fname = self._new_rand_file_name(end=".npy")
+                self._tx_on_rollback.append(partial(self._remove_file, fname))
+                chunk = np.lib.format.open_memmap(
+                    join(self._dirname, fname),
+                    mode="w+",
+                    dtype=dtype,
+                    shape=(chunk_rows,) + tuple(v["shape"]),
+                )
+                v["chunks"].append(fname)
+            else:
+                path = join(self._dirname, v["chunks"][-1])
+                _unshare_file(path)
+                chunk = np.lib.format.open_memmap(path, mode="r+")
+            n = min(chunk_rows - offset, len(rows) - i)
+            chunk[offset : offset + n] = rows[i : i + n]
+            chunk.flush()
+            del chunk
+            i += n
+            v["length"] += n
 
     def _getNPA(self, key):
-        d = self.db[key]
+        self.need_open()
+        t, d = self.get_value_and_value_type(key)
         assert d["magic"] == MAGIC_SIGN_NPARRAY
-        fname = d["fname"]
         if self.verbose > 1:
-            print("load NPA (key)", key, " (fname)", fname)
-        return self._loadNPA(fname)
+            print("load NPA (key)", key, " (marker)", d)
+        return self._loadNPA(d)
 
+    @_write_operation
     def newSubData(self, key, overwrite=False):
         """
         if key is not in database
@@ -384,54 +2359,81 @@ class PersistentDataStructure(object):
         this will automatically create a new
         file where the filename is internally
         managed (simple increasing number)
+
+        for a single file store a new node is created instead
         """
         self.need_open()
-        if key in self.db:
+        if key in self:
             if overwrite:
-                del self.db[key]
+                del self[key]
             else:
                 raise KeyError("can NOT create new SubData, key already found!")
 
-        d = {"name": self._new_rand_file_name(make_dir=True), "magic": MAGIC_SIGN}
+        d = self._new_sub_data_marker()
 
         if self.verbose > 1:
-            print("newSubData (key)", key, " (name)", d["name"])
+            print("newSubData (key)", key, " (marker)", d)
 
-        self.db[key] = d
-        self.db.commit()
-        return self.__class__(
-            name=d["name"], path=os.path.join(self._dirname), verbose=self.verbose
+        self._put(key, d, TYPE_SUB)
+        self._commit()
+        return self._sub_pds(d)
+
+    def _new_sub_data_marker(self):
+        """
+        create the storage for new sub-data (directory or node) and return the
+        dict to be stored in the db
+        """
+        if self._single_file:
+            self._begin_write()
+            self.db.conn.execute(
+                'INSERT INTO "%s" (parent) VALUES (?)' % SUBDATA_NODES_TABLE,
+                (self._node or 0,),
+            )
+            node = self.db.conn.select_one("SELECT last_insert_rowid()")[0]
+            return {"node": node, "magic": MAGIC_SIGN}
+
+        d = {"name": self._new_rand_file_name(make_dir=True), "magic": MAGIC_SIGN}
+        self._tx_on_rollback.append(
+            partial(shutil.rmtree, join(self._dirname, "__" + d["name"]), True)
         )
+        return d
+
+    def getData(self, key, create_sub_data=False, mmap_mode=_NO_DEFAULT):
+        """
+        return the value for the key
+
+        sub-data is returned as open PersistentDataStructure, numpy arrays are memory
+        mapped if mmap_mode is not None (defaults to the mmap_mode of the PDS)
 
-    def getData(self, key, create_sub_data=False):
+        if the key is not found and create_sub_data is True, new sub-data is created
+        for that key, otherwise a KeyError is raised
+        """
         self.need_open()
-        if key in self.db:
+        v = self._cache_get(key)
+        if v is not _NO_DEFAULT:
+            return v
+        row = self._get_raw(key)
+        if row is not None:
             if self.verbose > 1:
                 print("getData key exists")
 
-            t, v = self.get_value_and_value_type(key)
+            t, v = self._decode_typed(*row)
 
             if t == TYPE_SUB:
-                sub_db_name = v["name"]
-
                 if self.verbose > 1:
-                    print(
-                        "return subData stored as key", key, "using name", sub_db_name
-                    )
-                return self.__class__(
-                    name=sub_db_name,
-                    path=os.path.join(self._dirname),
-                    verbose=self.verbose,
-                )
+                    print("return subData stored as key", key, "using marker", v)
+                return self._sub_pds(v)
             elif t == TYPE_NPA:
                 if self.verbose > 1:
                     print("return nparray value")
-                return self._loadNPA(v["fname"])
+                return self._loadNPA(v, mmap_mode)
             elif t == TYPE_LOAD_ERR:
                 raise v
             else:
                 if self.verbose > 1:
                     print("return normal value")
+                if self._cache_bytes > 0:
+                    self._cache_put(key, v, len(row[1]))
                 return v
         else:
             if not create_sub_data:
@@ -443,18 +2445,77 @@ class PersistentDataStructure(object):
             else:
                 if self.verbose > 1:
                     print("getData key does NOT exists -> create subData")
-                return self.newSubData(key)
+                try:
+                    return self.newSubData(key)
+                except KeyError:
+                    if not self._multi_writer:
+                        raise
+                    # created by another process meanwhile
+                    return self.getData(key, mmap_mode=mmap_mode)
+
+    def get_many(self, keys, default=_NO_DEFAULT, as_dict=True, mmap_mode=_NO_DEFAULT):
+        """
+        return the values for many keys at once
+
+        The values are fetched with chunked queries (SQL_CHUNK_SIZE keys per
+        statement) instead of one query per key.
+        If default is given, it is used for keys which are not found, otherwise
+        a KeyError is raised.
+
+        returns a dict {key: value}, or, if as_dict is False, a list of the
+        values in the order of the keys
 
+        Note: as with getData, sub-data is returned as open PersistentDataStructure
+        which needs to be closed by the caller.
+        """
+        self.need_open()
+        keys = list(keys)
+        values = [default] * len(keys)
+        found = [False] * len(keys)
+        missing = []
+        for i, key in enumerate(keys):
+            v = self._cache_get(key)
+            if v is _NO_DEFAULT:
+                missing.append(i)
+            else:
+                values[i] = v
+                found[i] = True
+
+        for j, vtype, raw in self._fetch_raw([keys[i] for i in missing]):
+            i = missing[j]
+            t, v = self._decode_typed(vtype, raw)
+            if (t == TYPE_ORD) and (self._cache_bytes > 0):
+                self._cache_put(keys[i], v, len(raw))
+            values[i] = self._resolve(t, v, mmap_mode)
+            found[i] = True
+
+        if default is _NO_DEFAULT:
+            for i, f in enumerate(found):
+                if not f:
+                    raise KeyError(
+                        "key not found in PDS ({}, {})\nkey: {}".format(
+                            self._path, self._name, key_to_str(keys[i])
+                        )
+                    )
+
+        if as_dict:
+            return dict(zip(keys, values))
+        return values
+
+    @_write_operation
     def setDataFromSubData(self, key, subData, overwrite=False):
         """
         set an entry of the PDS with data from an other PDS
 
         this means copying the appropriate file to the right place
         and rename them
+
+        if this PDS is a single file store or subData is a node of a
+        single file store, the entries are copied one by one instead
         """
         self.need_open()
 
-        if key in self.db:
+        if key in self:
             if overwrite:
                 if self.verbose > 1:
                     print("overwrite True: del key")
@@ -464,9 +2525,8 @@ class PersistentDataStructure(object):
                     "can NOT create new SubData from Data, key already found!"
                 )
 
-        d = {"name": self._new_rand_file_name(make_dir=True), "magic": MAGIC_SIGN}
-        self.db[key] = d
-        self.db.commit()
+        d = self._new_sub_data_marker()
+        self._put(key, d, TYPE_SUB)
 
         if self.verbose > 1:
             print("")
@@ -475,103 +2535,494 @@ class PersistentDataStructure(object):
                 subData._name,
                 "new SubData (key)",
                 key,
-                " (name)",
-                d["name"],
+                " (marker)",
+                d,
             )
 
+        if ("node" in d) or (subData._root is not None):
+            with self._sub_pds(d) as sub_data:
+                sub_data._copy_entries(subData)
+            self._commit()
+            return
+
+        self._copy_sub_dir(d, subData._dirname, subData._name)
+        self._commit()
+
+    def _copy_sub_dir(self, d, src_dirname, src_name):
+        """
+        copy the directory of the sub-data src_name to the (empty) directory of
+        the new sub-data marker d
+        """
         dest_dir = os.path.join(self._dirname, "__" + d["name"])
         os.removedirs(dest_dir)
 
-        shutil.copytree(src=subData._dirname, dst=dest_dir)
+        shutil.copytree(
+            src=src_dirname, dst=dest_dir, copy_function=self._copy_tree_file
+        )
         os.rename(
-            src=os.path.join(dest_dir, subData._name + ".db"),
+            src=os.path.join(dest_dir, src_name + ".db"),
             dst=os.path.join(dest_dir, d["name"] + ".db"),
         )
 
+    @_write_operation
+    def move_subdata(self, key, other_pds, new_key, overwrite=False):
+        """
+        move the sub-data of the key to the key new_key of the PDS other_pds
+        (which may be this PDS), the entry for key is removed
+
+        The sub-data is not copied: its directory is renamed (or for a single file
+        store, the node is re-parented) and the two marker rows are updated (the new
+        one is committed first). Only if that is not possible (different file
+        systems, or different kinds of stores) the sub-data is copied (see
+        setDataFromSubData) and erased afterwards.
+
+        Moving the directory to an other PDS can not be undone by a rollback, so it
+        is not allowed while this PDS or other_pds is inside a transaction or has
+        uncommitted changes (autocommit=False). Within the same PDS the move is
+        rolled back together with the transaction.
+
+        Handles of the moved sub-data which are still in use become invalid.
+        """
+        self.need_open()
+        other_pds.need_open()
+        other_pds._need_writable()
+
+        row = self._get_raw(key, load_ordinary=False)
+        if row is None:
+            raise KeyError(key)
+        t, v = self._decode_typed(*row)
+        if t != TYPE_SUB:
+            raise TypeError("the value for key {!r} is not sub-data".format(key))
+        if (other_pds is self) and (new_key == key):
+            return
+        if self._contains_pds(v, other_pds):
+            raise ValueError("can NOT move sub-data into itself")
+        if (
+            ("node" not in v)
+            and (other_pds is not self)
+            and (not other_pds._single_file)
+            and any(
+                pds.in_transaction() or (not pds._autocommit)
+                for pds in (self, other_pds)
+            )
+        ):
+            raise RuntimeError(
+                "can NOT move SubData to an other PDS within a transaction "
+                "(or with autocommit=False)"
+            )
+
+        if new_key in other_pds:
+            if overwrite:
+                if other_pds.verbose > 1:
+                    print("overwrite True: del key")
+                other_pds.__delitem__(new_key)
+            else:
+                raise RuntimeError("can NOT move SubData, key already found!")
+
+        ident = v["node"] if "node" in v else v["name"]
+        if ident in self._tx_children:
+            raise RuntimeError(
+                "can NOT move SubData which is part of the current transaction"
+            )
+        pool_root = self if self._pool_root is None else self._pool_root
+        sub_data = pool_root._pool.pop((self._dirname, ident), None)
+        if sub_data is not None:
+            sub_data._pool_root = None
+            sub_data.close()
+
+        if "node" in v:
+            if other_pds._filename != self._filename:
+                return self._move_by_copy(key, v, other_pds, new_key)
+            self.db.conn.execute(
+                'UPDATE "%s" SET parent = ? WHERE id = ?' % SUBDATA_NODES_TABLE,
+                (other_pds._node or 0, v["node"]),
+            )
+            self._move_marker(key, other_pds, new_key, v)
+            return
+
+        if other_pds._single_file:
+            return self._move_by_copy(key, v, other_pds, new_key)
+        d = {"name": other_pds._new_rand_file_name(make_dir=True), "magic": MAGIC_SIGN}
+        src_dir = join(self._dirname, "__" + v["name"])
+        dest_dir = join(other_pds._dirname, "__" + d["name"])
+        try:
+            # replaces the empty directory
+            os.rename(src_dir, dest_dir)
+        except OSError:
+            # e.g. different file systems
+            os.rmdir(dest_dir)
+            return self._move_by_copy(key, v, other_pds, new_key)
+
+        renamed = []
+        undo = partial(
+            self._undo_move, src_dir, dest_dir, v["name"], d["name"], renamed
+        )
+        try:
+            for end in (".db", ".db-wal", ".db-shm"):
+                src = join(dest_dir, v["name"] + end)
+                if exists(src):
+                    os.rename(src, join(dest_dir, d["name"] + end))
+                    renamed.append(end)
+            self._tx_on_rollback.append(undo)
+            self._move_marker(key, other_pds, new_key, d)
+        except:
+            if undo in self._tx_on_rollback:
+                self._tx_on_rollback.remove(undo)
+            undo()
+            raise
+
+    @staticmethod
+    def _undo_move(src_dir, dest_dir, name, new_name, renamed):
+        """
+        move the directory of sub-data back (see move_subdata)
+        """
+        for end in renamed:
+            os.rename(join(dest_dir, new_name + end), join(dest_dir, name + end))
+        os.rename(dest_dir, src_dir)
+
+    def _move_marker(self, key, other_pds, new_key, d):
+        """
+        store the sub-data marker d for new_key in other_pds and remove the key
+        (without erasing the sub-data)
+        """
+        with other_pds.transaction():
+            other_pds._put(new_key, d, TYPE_SUB)
+            other_pds._commit()
+        self.db.conn.execute(
+            self._q("DELETE FROM {tab} WHERE {node}key = ?"), self._node_args + (key,)
+        )
+        self._cache_invalidate(key)
+        self._commit()
+
+    def _move_by_copy(self, key, v, other_pds, new_key):
+        with self._sub_pds(v) as sub_data:
+            other_pds.setDataFromSubData(new_key, sub_data)
+        self.__delitem__(key)
+
+    def _contains_pds(self, v, pds):
+        """
+        True if the PDS pds is the sub-data v (of this PDS) or part of it
+        """
+        if "node" in v:
+            if (pds._filename != self._filename) or (pds._node is None):
+                return False
+            node = self.db.conn.select_one(
+                "WITH RECURSIVE up(id) AS (VALUES (?) UNION ALL "
+                'SELECT n.parent FROM "{}" AS n JOIN up ON n.id = up.id) '
+                "SELECT 1 FROM up WHERE id = ?".format(SUBDATA_NODES_TABLE),
+                (pds._node, v["node"]),
+            )
+            return node is not None
+        sub_dir = join(self._dirname, "__" + v["name"])
+        return (pds._dirname + os.sep).startswith(sub_dir + os.sep)
+
+    def _copy_tree_file(self, src, dst):
+        """
+        copy function for the files of sub-data directories (see link_mode), only
+        array files may be hard linked
+        """
+        shared = ".npy" in os.path.basename(src)
+        _transfer_file(src, dst, self._link_mode, shared=shared)
+        return dst
+
+    def _copy_npa_files(self, src_dirname, v, copy=None):
+        """
+        copy the file(s) of the array marker v from the directory src_dirname
+        and return the new marker
+
+        if given, the files are copied by calling copy(func, *args)
+        """
+        v = dict(v)
+        if "fname" in v:
+            v["fname"] = self._copy_file(src_dirname, v["fname"], copy)
+        if "chunks" in v:
+            v["chunks"] = [self._copy_file(src_dirname, f, copy) for f in v["chunks"]]
+        return v
+
+    def _copy_file(self, src_dirname, fname, copy=None):
+        new_fname = self._new_rand_file_name(end="." + fname.split(".", 1)[1])
+        self._tx_on_rollback.append(partial(self._remove_file, new_fname))
+        args = (
+            join(src_dirname, fname),
+            join(self._dirname, new_fname),
+            self._link_mode,
+        )
+        if copy is None:
+            _transfer_file(*args)
+        else:
+            copy(_transfer_file, *args)
+        return new_fname
+
+    def _copy_entries(self, src):
+        """
+        copy all entries of the PDS src into this PDS, ordinary values are copied
+        without unpickling them
+        """
+        rows = list(
+            src.db.conn.select(
+                src._q(
+                    "SELECT key, vtype, value FROM {tab} WHERE {node}1 ORDER BY rowid"
+                ),
+                src._node_args,
+            )
+        )
+        for key, vtype, raw in rows:
+            if vtype == TYPE_ORD:
+                self._put_raw(key, raw, TYPE_ORD)
+                continue
+            t, v = src._decode_typed(vtype, raw)
+            if t == TYPE_ORD:
+                self._put_raw(key, raw, TYPE_ORD)
+            elif t == TYPE_NPA:
+                self._put(key, self._copy_npa_files(src._dirname, v), TYPE_NPA)
+            elif t == TYPE_SUB:
+                with src._sub_pds(v) as src_sub_data:
+                    with self.newSubData(key) as sub_data:
+                        sub_data._copy_entries(src_sub_data)
+            else:
+                raise v
+        self._commit()
+
     def mergeOtherPDS(
-        self, other_db_name, other_db_path="./", update="error", status_interval=5
+        self,
+        other_db_name,
+        other_db_path="./",
+        update="error",
+        status_interval=5,
+        workers=1,
     ):
         """
         update determines the update scheme
             error : raise error when key exists
             ignore: do nothing when key exists, keep old value
             update: update value when key exists with value from otherData
+
+        The conflicting keys are determined before anything is written, i.e., with
+        'error' nothing is merged if a key exists. The merge runs in a single
+        transaction. Ordinary values are copied without unpickling them, if
+        possible by attaching the sqlite file of the other PDS and a single
+        INSERT ... SELECT statement. Arrays and sub-data are copied as files
+        (see setDataFromSubData). status_interval applies to the progress of
+        copying arrays and sub-data.
+
+        With workers > 1 the array files and sub-data directories are copied
+        concurrently by a pool of that many threads. Which keys are merged does
+        not depend on workers, if any copy fails the whole merge is rolled back.
         """
-        error = False
-        if update == "error":
-            error = True
-        elif update == "ignore":
-            ignore = True
-        elif update == "update":
-            ignore = False
-        else:
+        if update not in ("error", "ignore", "update"):
             raise TypeError(
                 "update must be one of the following: 'error', 'ignore', 'update'"
             )
-
-        transfered = 0
-        ignored = 0
+        self.need_open()
+        self._need_writable()
 
         with self.__class__(
             name=other_db_name, path=other_db_path, verbose=self.verbose
         ) as otherData:
+            attached = (
+                (self._tx_depth == 0)
+                and (self._tx_parent is None)
+                and self._attach(otherData._filename)
+            )
+            try:
+                with self.transaction():
+                    self._begin_write()
+                    transfered, ignored = self._merge(
+                        otherData, update, attached, status_interval, workers
+                    )
+            finally:
+                if attached:
+                    self.db.conn.select_one("DETACH DATABASE merge_src")
+
+        print("merge summary:")
+        print("   transfered values:", transfered)
+        print("      ignored values:", ignored)
+
+    def _attach(self, filename):
+        """
+        attach the sqlite file as 'merge_src' to the connection, returns False if
+        that is not possible (uncommitted changes on the connection)
+        """
+        try:
+            self.db.conn.select_one("ATTACH DATABASE ? AS merge_src", (filename,))
+        except sqlite3.OperationalError as e:
+            if self.verbose > 1:
+                print("can not attach {} ({}), merge row by row".format(filename, e))
+            return False
+        return True
+
+    def _merge(self, other, update, attached, status_interval, workers):
+        """
+        merge the entries of the PDS other into this one (see mergeOtherPDS), if
+        attached is True the sqlite file of other is attached as 'merge_src'
+
+        returns the number of transferred and ignored values
+        """
+        other_tab = '"%s"' % other.db.tablename
+        # conflicting keys with their value type in this PDS
+        if attached:
+            conflicts = dict(
+                self.db.conn.select(
+                    self._q(
+                        "SELECT t.key, t.vtype FROM {tab} AS t JOIN merge_src."
+                        + other_tab
+                        + " AS o ON t.key = o.key WHERE {node}1"
+                    ),
+                    self._node_args,
+                )
+            )
+        else:
+            conflicts = {}
+            for rows in _chunks(
+                other._scan("key", None, None, None, None, 0, None), SQL_CHUNK_SIZE
+            ):
+                keys = [r[0] for r in rows]
+                for i, vtype, _ in self._fetch_raw(keys, load_ordinary=False):
+                    conflicts[keys[i]] = vtype
+
+        if conflicts and (update == "error"):
+            raise KeyError(
+                "merge error, {} key(s) already found in PDS (e.g. {})".format(
+                    len(conflicts), key_to_str(next(iter(conflicts)))
+                )
+            )
+        if update == "update":
+            # sub-data and arrays are removed once the merge has been committed
+            for key, vtype in conflicts.items():
+                if vtype != TYPE_ORD:
+                    self.__delitem__(key)
+            ignored = 0
+        else:
+            ignored = len(conflicts)
+        self._cache_invalidate()
+
+        # ordinary values (as stored, without unpickling)
+        if attached:
+            c0 = self.db.conn.select_one("SELECT total_changes()")[0]
+            self.db.conn.execute(
+                self._q(
+                    "{} INTO {{tab}} ({}key, value, vtype) SELECT {}key, value, vtype "
+                    "FROM merge_src.{} WHERE vtype = ?".format(
+                        "REPLACE" if update == "update" else "INSERT OR IGNORE",
+                        "" if self._root is None else "node, ",
+                        "" if self._root is None else "?, ",
+                        other_tab,
+                    )
+                ),
+                self._node_args + (TYPE_ORD,),
+            )
+            transfered = self.db.conn.select_one("SELECT total_changes()")[0] - c0
+        else:
+            transfered = 0
+            for rows in _chunks(
+                other._scan("key, vtype, value", None, None, None, None, 0, None),
+                SQL_CHUNK_SIZE,
+            ):
+                rows = [
+                    self._node_args + (key, raw, vtype)
+                    for key, vtype, raw in rows
+                    if (vtype == TYPE_ORD)
+                    and ((update == "update") or (key not in conflicts))
+                ]
+                self.db.conn.executemany(self._insert_query(), rows)
+                transfered += len(rows)
+
+        # arrays, sub-data and rows without value type, the db is modified by this
+        # thread only, the files are copied by the executor (if workers > 1)
+        executor = None
+        futures = []
+        if workers > 1:
+            executor = ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix="pds-merge"
+            )
 
-            c = progress.UnsignedIntValue(val=0)
-            m = progress.UnsignedIntValue(val=len(otherData))
-
-            with progress.ProgressBarFancy(
-                count=c, max_count=m, interval=status_interval
-            ) as pb:
-                if status_interval > 0:
-                    pb.start()
-                for k in otherData:
-
-                    if k in self:
-                        if error:
-                            raise KeyError("merge error, key already found in PDS")
-                        else:
-                            if ignore:
-                                if self.verbose > 1:
-                                    print("ignore key", k)
-                                ignored += 1
-                                continue
-                            else:
-                                if self.verbose > 1:
-                                    print("replace key", k)
-                                del self[k]
-
-                    value = otherData[k]
-                    try:
-                        self[k] = value
-                        transfered += 1
-                    finally:
-                        if isinstance(value, self.__class__):
-                            value.close()
+        def copy(f, *args):
+            if executor is None:
+                f(*args)
+            else:
+                futures.append(executor.submit(f, *args))
 
+        markers = list(
+            other.db.conn.select(
+                "SELECT key, vtype, value FROM %s WHERE vtype IS NOT ? ORDER BY rowid"
+                % other_tab,
+                (TYPE_ORD,),
+            )
+        )
+        c = progress.UnsignedIntValue(val=0)
+        m = progress.UnsignedIntValue(val=len(markers))
+        with progress.ProgressBarFancy(
+            count=c, max_count=m, interval=status_interval
+        ) as pb:
+            if status_interval > 0:
+                pb.start()
+            try:
+                for key, vtype, raw in markers:
                     with c.get_lock():
                         c.value += 1
-                    sys.stdout.flush()
-
-            print("merge summary:")
-            print("   transfered values:", transfered)
-            print("      ignored values:", ignored)
+                    if (key in conflicts) and (update == "ignore"):
+                        if self.verbose > 1:
+                            print("ignore key", key)
+                        continue
+                    t, v = other._decode_typed(vtype, raw)
+                    if t == TYPE_ORD:
+                        self._put_raw(key, raw, TYPE_ORD)
+                    elif t == TYPE_NPA:
+                        v = self._copy_npa_files(other._dirname, v, copy)
+                        self._put(key, v, TYPE_NPA)
+                    elif t == TYPE_SUB:
+                        self._merge_sub_data(key, other, v, copy)
+                    else:
+                        raise v
+                    transfered += 1
+                for f in futures:
+                    f.result()
+            finally:
+                if executor is not None:
+                    executor.shutdown(wait=True, cancel_futures=True)
+        self._commit()
+        return transfered, ignored
+
+    def _merge_sub_data(self, key, other, v, copy):
+        """
+        set the key to a copy of the sub-data v of the PDS other, the directory
+        is copied by calling copy(func, *args)
+        """
+        with other._sub_pds(v) as sub_data:
+            if self._single_file or (sub_data._root is not None):
+                self.setDataFromSubData(key, sub_data, overwrite=True)
+                return
+            d = self._new_sub_data_marker()
+            self._put(key, d, TYPE_SUB)
+            copy(self._copy_sub_dir, d, sub_data._dirname, sub_data._name)
 
     def __len__(self):
         self.need_open()
-        return len(self.db)
+        return self.db.conn.select_one(
+            self._q("SELECT COUNT(*) FROM {tab} WHERE {node}1"), self._node_args
+        )[0]
 
     # implements the iterator
     def __iter__(self):
         self.need_open()
-        db_iter = self.db.__iter__()
+        db_iter = self.db.conn.select(
+            self._q("SELECT key FROM {tab} WHERE {node}1 ORDER BY rowid"),
+            self._node_args,
+        )
         for k in db_iter:
-            yield k
+            yield k[0]
         return
 
     # implements the 'in' statement
     def __contains__(self, key):
         self.need_open()
-        return key in self.db
+        return (
+            self.db.conn.select_one(
+                self._q("SELECT 1 FROM {tab} WHERE {node}key = ?"),
+                self._node_args + (key,),
+            )
+            is not None
+        )
 
     # implements '[]' operator getter
     def __getitem__(self, key):
@@ -589,21 +3040,210 @@ class PersistentDataStructure(object):
             print("set", key, "to", value, "in", self._filename)
 
     # implements '[]' operator deletion
+    @_write_operation
     def __delitem__(self, key):
         self.need_open()
-        t, v = self.get_value_and_value_type(key)
-        if t == TYPE_SUB:
-            with self[key] as pds:
-                pds.erase()
-        elif t == TYPE_NPA:
-            fname = v["fname"]
-            try:
-                os.remove(os.path.join(self._dirname, fname))
-            except FileNotFoundError:
-                pass
+        row = self._get_raw(key, load_ordinary=False)
+        if row is None:
+            raise KeyError(key)
+        self._defer_remove(*self._decode_typed(*row))
+        self.db.conn.execute(
+            self._q("DELETE FROM {tab} WHERE {node}key = ?"), self._node_args + (key,)
+        )
+        self._cache_invalidate(key)
+        self._commit()
 
-        del self.db[key]
-        self.db.commit()
+
+class AsyncPersistentDataStructure(object):
+    """
+    asyncio front-end of a PersistentDataStructure
+
+    All operations of the (not thread safe) PersistentDataStructure run on a single
+    worker thread, so they do not block the event loop. The PDS is created lazily
+    (see the option lazy), the other arguments are passed to PersistentDataStructure.
+
+    Concurrent get() of the same key share a single read. Writes (set, delete) which
+    are issued while the previous batch of writes is running are collected and
+    applied within a single transaction. Reads wait until the writes issued
+    before them have been applied, so they see these writes.
+
+        async with AsyncPersistentDataStructure("data") as data:
+            await data.set("a", 1)
+            a = await data.get("a")
+    """
+
+    def __init__(self, name, path="./", **kwargs):
+        kwargs["lazy"] = True
+        pds = PersistentDataStructure(name, path, **kwargs)
+        self._init(pds, ThreadPoolExecutor(max_workers=1), owner=True)
+
+    def _init(self, pds, executor, owner):
+        self.pds = pds
+        self._executor = executor
+        self._owner = owner
+        self._reads = {}
+        self._writes = []
+        self._flush_task = None
+        # the last write issued, see _read()
+        self._last_write = None
+
+    @classmethod
+    def _wrap(cls, pds, executor):
+        """
+        async front-end for sub-data, sharing the worker thread
+        """
+        obj = cls.__new__(cls)
+        obj._init(pds, executor, owner=False)
+        return obj
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def _run(self, f, *args):
+        r = await asyncio.get_running_loop().run_in_executor(
+            self._executor, partial(f, *args)
+        )
+        if isinstance(r, PersistentDataStructure):
+            return self._wrap(r, self._executor)
+        return r
+
+    async def get(self, key, **kwargs):
+        """
+        return the value for the key (see PersistentDataStructure.getData),
+        sub-data is returned as AsyncPersistentDataStructure
+
+        Note that concurrent calls for the same key return the same object.
+        """
+        write = self._last_write
+        if kwargs:
+            return await self._read(write, partial(self.pds.getData, key, **kwargs))
+        try:
+            read = self._reads[key]
+        except KeyError:
+            read = asyncio.ensure_future(self._read(write, self.pds.getData, key))
+            self._reads[key] = read
+            read.add_done_callback(partial(self._read_done, key))
+        return await asyncio.shield(read)
+
+    def _read_done(self, key, read):
+        if self._reads.get(key) is read:
+            del self._reads[key]
+
+    async def _read(self, write, f, *args):
+        """
+        run f once the write (and with it all writes issued before) has been
+        applied
+        """
+        if (write is not None) and not write.done():
+            await asyncio.wait([write])
+        return await self._run(f, *args)
+
+    async def get_many(self, keys, **kwargs):
+        """
+        see PersistentDataStructure.get_many
+        """
+        return await self._read(
+            self._last_write, partial(self.pds.get_many, list(keys), **kwargs)
+        )
+
+    async def contains(self, key):
+        return await self._read(self._last_write, self.pds.__contains__, key)
+
+    async def len(self):
+        return await self._read(self._last_write, self.pds.__len__)
+
+    async def set(self, key, value):
+        """
+        set the value for the key (overwriting an existing value)
+        """
+        await self._write(self.pds.__setitem__, key, value)
+
+    async def delete(self, key):
+        await self._write(self.pds.__delitem__, key)
+
+    async def _write(self, f, key, *args):
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+        # later reads must not join a read which was issued before this write
+        self._reads.pop(key, None)
+        self._writes.append((partial(f, key, *args), done))
+        self._last_write = done
+        if self._flush_task is None:
+            self._flush_task = loop.create_task(self._flush())
+        await done
+
+    async def _flush(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while self._writes:
+                batch, self._writes = self._writes, []
+                try:
+                    results = await loop.run_in_executor(
+                        self._executor, self._apply, [f for f, _ in batch]
+                    )
+                except Exception as e:
+                    results = [e] * len(batch)
+                for (_, done), r in zip(batch, results):
+                    if done.done():
+                        continue
+                    if isinstance(r, Exception):
+                        done.set_exception(r)
+                    else:
+                        done.set_result(r)
+        finally:
+            self._flush_task = None
+
+    def _apply(self, writes):
+        """
+        run the writes in a single transaction, return the result (or the exception)
+        of each write
+
+        each write is a write operation of the PDS, i.e., a failing write is rolled
+        back on its own (see _write_operation)
+        """
+        results = []
+        with self.pds.transaction():
+            for f in writes:
+                try:
+                    results.append(f())
+                except Exception as e:
+                    results.append(e)
+        return results
+
+    async def items(self, fetch_size=None, **kwargs):
+        """
+        iterate asynchronously over the (key, value) pairs (see
+        PersistentDataStructure.items), chunks of fetch_size pairs are read at once
+        """
+        if fetch_size is None:
+            fetch_size = FETCH_SIZE
+        it = await self._read(
+            self._last_write, partial(self.pds.items, fetch_size=fetch_size, **kwargs)
+        )
+        while True:
+            chunk = await self._run(lambda: list(itertools.islice(it, fetch_size)))
+            for key, v in chunk:
+                if isinstance(v, PersistentDataStructure):
+                    v = self._wrap(v, self._executor)
+                yield key, v
+            if len(chunk) < fetch_size:
+                return
+
+    async def commit(self):
+        await self._run(self.pds.commit)
+
+    async def close(self):
+        """
+        wait for the pending writes and close the PDS (and the worker thread)
+        """
+        while self._flush_task is not None:
+            await self._flush_task
+        await self._run(self.pds.close)
+        if self._owner:
+            self._executor.shutdown()
 
 
 class PersistentDataStructure_HDF5(object):
@@ -5,12 +5,14 @@ from __future__ import division, print_function
 import sys
 import pickle
 import os
-from os.path import abspath, dirname, split, exists
+from os.path import abspath, dirname, split, exists, join
 from shutil import rmtree
 import warnings
+from functools import partial
 import numpy as np
 import sqlitedict as sqd
 import multiprocessing as mp
+import threading
 import time
 
 # Add parent directory to beginning of path variable
@@ -36,6 +38,7 @@ if sys.version_info[0] == 2:
 rmtree("__test_data", ignore_errors=True)
 rmtree("__data", ignore_errors=True)
 rmtree("__base", ignore_errors=True)
+rmtree("__data_vtype", ignore_errors=True)
 
 
 def test_pd():
@@ -491,6 +494,229 @@ def test_npa():
             data.erase()
 
 
+def test_npa_mmap():
+    a = np.linspace(0, 1, 100).reshape(10, 10)
+    data = None
+    try:
+        with PDS(name="data_mmap", verbose=VERBOSE) as data:
+            data["a"] = a
+            with data.newSubData("s") as s:
+                s["a"] = a
+            assert not isinstance(data["a"], np.memmap)
+            b = data.getData("a", mmap_mode="r")
+            assert isinstance(b, np.memmap)
+            assert np.all(b[2:4] == a[2:4])
+
+        with PDS(name="data_mmap", verbose=VERBOSE, mmap_mode="r") as data:
+            assert isinstance(data["a"], np.memmap)
+            assert not isinstance(data.getData("a", mmap_mode=None), np.memmap)
+            assert isinstance(data.get_many(["a"])["a"], np.memmap)
+            with data["s"] as s:
+                assert isinstance(s["a"], np.memmap)
+                assert np.all(s["a"] == a)
+    finally:
+        if data is not None:
+            data.erase()
+
+
+def test_npa_inline():
+    small = np.arange(12, dtype=np.int16).reshape(3, 4).T
+    rec = np.zeros(3, dtype=[("x", "<f8"), ("n", "<i4")])
+    rec["x"] = [1.5, 2.5, 3.5]
+    large = np.random.rand(1000)
+    data = None
+    try:
+        with PDS(
+            name="data_inline", verbose=VERBOSE, npa_inline_threshold=1000
+        ) as data:
+            data.update({"small": small, "rec": rec, "large": large})
+            with data.newSubData("s") as s:
+                s["small"] = small
+                s["large"] = large
+            # only the large arrays are stored in files
+            npy_files = [f for f in os.listdir(data._dirname) if f.endswith(".npy")]
+            assert len(npy_files) == 1
+
+        with PDS(name="data_inline", verbose=VERBOSE, mmap_mode="r") as data:
+            assert data.is_NPA("small")
+            b = data["small"]
+            assert (b.dtype == small.dtype) and (b.shape == small.shape)
+            assert np.all(b == small)
+            b[0, 0] = 100
+            assert np.all(data["rec"] == rec)
+            assert np.all(data["large"] == large)
+            with data["s"] as s:
+                assert np.all(s["small"] == small)
+                del s["large"]
+            del data["small"]
+            data.clear()
+            assert os.listdir(data._dirname) == ["data_inline.db"]
+    finally:
+        if data is not None:
+            data.erase()
+
+
+def test_append_array():
+    data = None
+    try:
+        with PDS(name="data_append", verbose=VERBOSE) as data:
+            assert (
+                data.append_array("ts", np.arange(6).reshape(3, 2), chunk_rows=4) == 3
+            )
+            assert data.append_array("ts", [[6, 7], [8, 9], [10, 11]]) == 6
+            with data.transaction():
+                data.append_array("ts", np.arange(12, 20).reshape(4, 2))
+            assert data.is_NPA("ts")
+
+            # appending to an array stored by setData converts it to chunks
+            data["a"] = np.arange(3.0)
+            data.append_array("a", [3, 4])
+            npy_files = [f for f in os.listdir(data._dirname) if f.endswith(".npy")]
+            assert len(npy_files) == 3 + 1
+
+            try:
+                data.append_array("ts", np.zeros((1, 3)))
+            except ValueError:
+                pass
+            else:
+                assert False
+            data["o"] = 1
+            try:
+                data.append_array("o", [1])
+            except TypeError:
+                pass
+            else:
+                assert False
+
+            # a failing transaction leaves the array unchanged
+            try:
+                with data.transaction():
+                    data.append_array("ts", [[-1, -1]] * 5)
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+
+        with PDS(name="data_append", verbose=VERBOSE) as data:
+            assert np.all(data["ts"] == np.arange(20).reshape(10, 2))
+            assert np.all(data["a"] == np.arange(5.0))
+            npy_files = [f for f in os.listdir(data._dirname) if f.endswith(".npy")]
+            assert len(npy_files) == 3 + 1
+            with data.newSubData("s") as s:
+                s.append_array("x", [1, 2, 3], chunk_rows=10)
+                assert isinstance(s.getData("x", mmap_mode="r"), np.memmap)
+            data["s_copy"] = data["s"]
+            with data["s_copy"] as s:
+                assert np.all(s["x"] == [1, 2, 3])
+            del data["ts"]
+            data.clear()
+            assert os.listdir(data._dirname) == ["data_append.db"]
+    finally:
+        if data is not None:
+            data.erase()
+
+
+def test_compression():
+    a = np.zeros((100, 100))
+    a[::10, ::7] = 1.5
+    big = list(range(10)) * 100
+    data = None
+    try:
+        with PDS(name="data_compr", verbose=VERBOSE) as data:
+            data["plain"] = big
+            data["a_plain"] = a
+
+        for codec in ["zlib", "lzma", "bz2"]:
+            with PDS(
+                name="data_compr",
+                verbose=VERBOSE,
+                compression=codec,
+                compression_level=1,
+            ) as data:
+                data[codec] = big
+                data["a_" + codec] = a
+                data["small"] = 1
+                with data.getData("s_" + codec, create_sub_data=True) as s:
+                    assert s._compression == codec
+                    s["big"] = big
+
+        with PDS(name="data_compr", verbose=VERBOSE) as data:
+            for k in ["plain", "zlib", "lzma", "bz2"]:
+                assert data[k] == big
+                assert np.all(data["a_" + k] == a)
+            for codec in ["zlib", "lzma", "bz2"]:
+                with data["s_" + codec] as s:
+                    assert s["big"] == big
+            assert data["small"] == 1
+            files = os.listdir(data._dirname)
+            assert len([f for f in files if f.endswith(".npy.zlib")]) == 1
+            # compressed values are stored with their codec
+            raw = data.db.conn.select_one(
+                'SELECT value FROM "unnamed" WHERE key = ?', ("lzma",)
+            )[0]
+            assert raw.startswith(b"\x00PDSlzma\x00")
+            assert len(raw) < len(pickle.dumps(big))
+            data.clear()
+            assert os.listdir(data._dirname) == ["data_compr.db"]
+
+        try:
+            PDS(name="data_compr", verbose=VERBOSE, compression="foo")
+        except ValueError:
+            pass
+        else:
+            assert False
+    finally:
+        if data is not None:
+            data.erase()
+
+
+def test_serializer():
+    a = np.random.rand(100, 3)
+    value = {"a": a, "b": bytearray(b"x" * 1000), "l": [1, 2.5, "s"]}
+    data = None
+    try:
+        with PDS(name="data_ser", verbose=VERBOSE) as data:
+            data["pickle"] = value
+        with PDS(name="data_ser", verbose=VERBOSE, serializer="pickle5") as data:
+            data["pickle5"] = value
+            data.update({"many": value})
+            with data.newSubData("s") as s:
+                s["x"] = value
+        with PDS(
+            name="data_ser",
+            verbose=VERBOSE,
+            serializer="binfootprint",
+            compression="zlib",
+        ) as data:
+            data["bf"] = {"l": [1, 2.5, "s"], "b": b"bytes"}
+
+        with PDS(name="data_ser", verbose=VERBOSE) as data:
+            for k in ["pickle", "pickle5", "many"]:
+                v = data[k]
+                assert np.all(v["a"] == a)
+                assert v["b"] == value["b"]
+                assert v["l"] == value["l"]
+            # arrays loaded from out-of-band buffers are writable
+            data["pickle5"]["a"][0, 0] = 1
+            with data["s"] as s:
+                assert np.all(s["x"]["a"] == a)
+            assert data["bf"] == {"l": [1, 2.5, "s"], "b": b"bytes"}
+            assert data.is_subdata("s")
+            raw = data.db.conn.select_one(
+                'SELECT value FROM "unnamed" WHERE key = ?', ("pickle5",)
+            )[0]
+            assert raw.startswith(b"\x01PDSpickle5\x00")
+
+        try:
+            PDS(name="data_ser", verbose=VERBOSE, serializer="foo")
+        except ValueError:
+            pass
+        else:
+            assert False
+    finally:
+        if data is not None:
+            data.erase()
+
+
 def test_merge():
 
     a = np.random.rand(5)
@@ -561,6 +787,153 @@ def test_merge():
             d2.erase()
 
 
+def test_merge_bulk():
+    a = np.arange(10)
+    d1 = None
+    d2 = None
+    try:
+        with PDS(name="d1", verbose=VERBOSE) as d1:
+            d1.clear()
+            d1.set_many([("k{}".format(i), i) for i in range(1000)])
+            d1["a"] = a
+            d1["x"] = "x1"
+            with d1.newSubData("sub") as sub:
+                sub["s"] = 1
+
+        with PDS(name="d2", verbose=VERBOSE) as d2:
+            d2.clear()
+            d2["k0"] = "old"
+            d2["a"] = 0
+            with d2.newSubData("x") as sub:
+                sub["s"] = 2
+                sub_dir = sub._dirname
+
+            # nothing is merged if a key exists
+            try:
+                d2.mergeOtherPDS(other_db_name="d1", status_interval=0)
+            except KeyError:
+                pass
+            else:
+                assert False, "KeyError expected"
+            assert len(d2) == 3
+
+            d2.mergeOtherPDS(other_db_name="d1", update="ignore", status_interval=0)
+            assert len(d2) == 1003
+            assert (d2["k0"] == "old") and (d2["k1"] == 1) and (d2["a"] == 0)
+            assert d2["sub"]["s"] == 1
+
+            # update within a transaction, the other file is not attached then
+            with d2.transaction():
+                d2.mergeOtherPDS(other_db_name="d1", update="update", status_interval=0)
+            assert d2["k0"] == 0
+            assert np.all(d2["a"] == a)
+            assert d2["x"] == "x1"
+            assert not os.path.exists(sub_dir)
+
+            d2.clear()
+            d2.mergeOtherPDS(other_db_name="d1", status_interval=0)
+            assert len(d2) == 1003
+            assert d2["k999"] == 999
+    finally:
+        if d1 is not None:
+            d1.erase()
+        if d2 is not None:
+            d2.erase()
+
+
+def test_merge_workers():
+    a = np.arange(100)
+    d1 = None
+    d2 = None
+    try:
+        with PDS(name="d1", verbose=VERBOSE) as d1:
+            d1.clear()
+            for i in range(8):
+                with d1.newSubData("sub{}".format(i)) as sub:
+                    sub["i"] = i
+                    sub["a"] = a + i
+                    with sub.newSubData("deep") as deep:
+                        deep["a"] = a - i
+            d1["a"] = a
+
+        with PDS(name="d2", verbose=VERBOSE) as d2:
+            d2.clear()
+            d2["sub0"] = "keep"
+            d2.mergeOtherPDS(
+                other_db_name="d1", update="ignore", status_interval=0, workers=4
+            )
+            assert len(d2) == 9
+            assert d2["sub0"] == "keep"
+            assert np.all(d2["a"] == a)
+            for i in range(1, 8):
+                with d2["sub{}".format(i)] as sub:
+                    assert sub["i"] == i
+                    assert np.all(sub["a"] == a + i)
+                    assert np.all(sub["deep"]["a"] == a - i)
+    finally:
+        if d1 is not None:
+            d1.erase()
+        if d2 is not None:
+            d2.erase()
+
+
+def test_link_mode():
+    a = np.arange(100)
+    d1 = None
+    d2 = None
+    try:
+        with PDS(name="d1", verbose=VERBOSE) as d1:
+            d1.clear()
+            d1["a"] = a
+            d1.append_array("c", np.arange(3))
+            with d1.newSubData("sub") as sub:
+                sub["a"] = a
+                sub["x"] = 1
+
+        with PDS(name="d2", verbose=VERBOSE, link_mode="hardlink") as d2:
+            d2.clear()
+            d2.mergeOtherPDS(other_db_name="d1", status_interval=0)
+            assert np.all(d2["a"] == a)
+            with d2["sub"] as sub:
+                assert np.all(sub["a"] == a)
+                assert sub._link_mode == "hardlink"
+                assert os.stat(sub._filename).st_nlink == 1
+                for fname in os.listdir(sub._dirname):
+                    if fname.endswith(".npy"):
+                        assert os.stat(join(sub._dirname, fname)).st_nlink == 2
+            fnames = [f for f in os.listdir(d2._dirname) if f.endswith(".npy")]
+            assert len(fnames) == 2
+            for fname in fnames:
+                assert os.stat(join(d2._dirname, fname)).st_nlink == 2
+
+            # appending to a shared chunk does not modify the other store
+            d2.append_array("c", np.arange(3, 5))
+            assert np.all(d2["c"] == np.arange(5))
+
+        with PDS(name="d1", verbose=VERBOSE) as d1:
+            assert np.all(d1["c"] == np.arange(3))
+            d1.append_array("c", np.arange(10, 12))
+        with PDS(name="d2", verbose=VERBOSE) as d2:
+            assert np.all(d2["c"] == np.arange(5))
+
+            d2.clear()
+            d2._link_mode = "auto"
+            d2.mergeOtherPDS(other_db_name="d1", status_interval=0)
+            assert np.all(d2["c"] == [0, 1, 2, 10, 11])
+
+        try:
+            PDS(name="d3", verbose=VERBOSE, link_mode="symlink", lazy=True)
+        except ValueError:
+            pass
+        else:
+            assert False, "ValueError expected"
+    finally:
+        if d1 is not None:
+            d1.erase()
+        if d2 is not None:
+            d2.erase()
+
+
 def test_merge_fname_conflict():
     class PDS_det_fname(PDS):
         def newNPA(self, key, nparray):
@@ -648,6 +1021,1031 @@ def test_merge_fname_conflict():
         d2.erase()
 
 
+def test_transaction():
+    a = np.arange(10)
+    data = None
+    try:
+        with PDS(name="data_tx", verbose=VERBOSE) as data:
+            data["keep"] = 1
+            with data.transaction():
+                for i in range(100):
+                    data[i] = i
+                data["a"] = a
+                with data.newSubData("s1") as s1:
+                    s1["x"] = "x"
+                    assert s1.in_transaction()
+                with data["s1"] as s1:
+                    assert s1["x"] == "x"
+                    s1["y"] = "y"
+
+        with PDS(name="data_tx", verbose=VERBOSE) as data:
+            assert len(data) == 103
+            assert data[99] == 99
+            assert np.all(data["a"] == a)
+            with data["s1"] as s1:
+                assert s1["x"] == "x"
+                assert s1["y"] == "y"
+
+            dir_content_before = sorted(os.listdir(data._dirname))
+            try:
+                with data.transaction():
+                    data["new"] = 1
+                    data["keep"] = 2
+                    data["b"] = np.arange(5)
+                    del data["a"]
+                    with data.newSubData("s2") as s2:
+                        s2["z"] = 1
+                    with data["s1"] as s1:
+                        s1["x"] = "changed"
+                    raise ValueError("abort")
+            except ValueError:
+                pass
+
+            assert "new" not in data
+            assert "b" not in data
+            assert "s2" not in data
+            assert data["keep"] == 1
+            assert np.all(data["a"] == a)
+            with data["s1"] as s1:
+                assert s1["x"] == "x"
+            assert sorted(os.listdir(data._dirname)) == dir_content_before
+
+        with PDS(name="data_tx", verbose=VERBOSE, autocommit=False) as data:
+            data["new"] = 1
+            data.rollback()
+            assert "new" not in data
+            data["new"] = 2
+            data.commit()
+            data["new2"] = 3
+
+        with PDS(name="data_tx", verbose=VERBOSE) as data:
+            assert data["new"] == 2
+            assert data["new2"] == 3
+
+            # a failing write is rolled back on its own
+            lock = threading.Lock()
+            try:
+                data["a"] = lock
+            except TypeError:
+                pass
+            data["other"] = 1
+            assert np.all(data["a"] == a)
+            with data.transaction():
+                try:
+                    data["a"] = lock
+                except TypeError:
+                    pass
+                data["other"] = 2
+            assert np.all(data["a"] == a)
+            assert data["other"] == 2
+            assert sorted(os.listdir(data._dirname)) == dir_content_before
+    finally:
+        if data is not None:
+            data.erase()
+
+
+def test_set_many():
+    a = np.arange(10)
+    data = None
+    try:
+        with PDS(name="data_many", verbose=VERBOSE) as data:
+            n = data.set_many(((i, str(i)) for i in range(1000)))
+            assert n == 1000
+            data.set_many({"a": a, b"bin": (1, 2)})
+            with data.newSubData("s") as s:
+                s["x"] = 1
+
+            try:
+                data.set_many({"new": 1, 5: "5"})
+            except KeyError:
+                pass
+            else:
+                assert False, "KeyError expected"
+            assert "new" not in data
+
+            fname = data.db["a"]["fname"]
+            data.update({5: 5, "a": "no array", "s": "no sub data"}, new=1)
+            assert data[5] == 5
+            assert data["a"] == "no array"
+            assert data["s"] == "no sub data"
+            assert data["new"] == 1
+            assert not exists(os.path.join(data._dirname, fname))
+            assert len(os.listdir(data._dirname)) == 1
+
+        with PDS(name="data_many", verbose=VERBOSE) as data:
+            assert len(data) == 1004
+            assert data[999] == "999"
+            assert data[b"bin"] == (1, 2)
+    finally:
+        if data is not None:
+            data.erase()
+
+
+def test_get_many():
+    a = np.arange(10)
+    data = None
+    try:
+        with PDS(name="data_get_many", verbose=VERBOSE) as data:
+            data.set_many(((i, i * i) for i in range(1000)))
+            data["a"] = a
+            with data.newSubData("s") as s:
+                s["x"] = 1
+
+            keys = list(range(999, -1, -1))
+            assert data.get_many(keys, as_dict=False) == [k * k for k in keys]
+
+            d = data.get_many([3, "a", "s", "missing"], default=None)
+            assert d[3] == 9
+            assert np.all(d["a"] == a)
+            with d["s"] as s:
+                assert s["x"] == 1
+            assert d["missing"] is None
+
+            try:
+                data.get_many([1, "missing"])
+            except KeyError:
+                pass
+            else:
+                assert False, "KeyError expected"
+    finally:
+        if data is not None:
+            data.erase()
+
+
+class CountLoads(object):
+    loads = 0
+
+    def __init__(self, x):
+        self.x = x
+
+    def __setstate__(self, state):
+        CountLoads.loads += 1
+        self.__dict__.update(state)
+
+
+def test_value_type_column():
+    a = np.arange(10)
+    data = None
+    try:
+        # store as written by an older version (no value type column)
+        os.mkdir("__data_vtype")
+        with sqd.SqliteDict("__data_vtype/data_vtype.db", autocommit=True) as d:
+            d["o"] = CountLoads(1)
+            d["s"] = {"name": "sub", "magic": pd.MAGIC_SIGN}
+        with PDS(name="sub", path="__data_vtype", verbose=VERBOSE) as s:
+            s["x"] = 1
+
+        with PDS(name="data_vtype", verbose=VERBOSE) as data:
+            tab = data.db.tablename
+            rows = dict(data.db.conn.select('SELECT key, vtype FROM "%s"' % tab))
+            assert rows == {"o": pd.TYPE_ORD, "s": pd.TYPE_SUB}
+            data["a"] = a
+
+        with PDS(name="data_vtype", verbose=VERBOSE) as data:
+            CountLoads.loads = 0
+            assert data.get_value_type("o") == pd.TYPE_ORD
+            assert data.get_value_type("a") == pd.TYPE_NPA
+            assert data.is_subdata("s")
+            assert not data.is_subdata("o")
+            assert data.is_NPA("a")
+            assert not data.is_NPA("missing")
+
+            # the old array is removed only if the new value has been written
+            try:
+                data["a"] = threading.Lock()
+            except TypeError:
+                pass
+            data["other"] = 1
+            assert np.all(data["a"] == a)
+            data.show_stat()
+            data.clear()
+            assert CountLoads.loads == 0
+            assert os.listdir(data._dirname) == ["data_vtype.db"]
+    finally:
+        if data is not None:
+            data.erase()
+
+
+def test_single_file():
+    a = np.arange(10)
+    data = None
+    data_dirs = None
+    try:
+        with PDS(name="data_sf", verbose=VERBOSE, single_file=True) as data:
+            data["k"] = 1
+            with data.newSubData("s1") as s1:
+                s1["k"] = 2
+                s1["a"] = a
+                with s1.getData("s2", create_sub_data=True) as s2:
+                    s2["k"] = 3
+                    s2["a"] = a
+                assert len(s1) == 3
+                assert sorted(s1) == ["a", "k", "s2"]
+            with data.newSubData("del") as d:
+                d["x"] = 1
+                d["a"] = a
+
+            assert len(data) == 3
+            assert data.is_subdata("s1")
+            # no directories for the sub-data, only the array files
+            assert [f for f in os.listdir(data._dirname) if not f.endswith(".npy")] == [
+                "data_sf.db"
+            ]
+            assert len(os.listdir(data._dirname)) == 4
+
+            del data["del"]
+            assert len(os.listdir(data._dirname)) == 3
+
+            try:
+                with data.transaction():
+                    with data["s1"] as s1:
+                        s1["k"] = "changed"
+                        with s1.newSubData("tmp") as tmp:
+                            tmp["x"] = 1
+                    raise ValueError("abort")
+            except ValueError:
+                pass
+
+            # sub-data shares the transaction with the root
+            with data["s1"] as s1:
+                try:
+                    with s1.transaction():
+                        s1["x"] = 1
+                        data["y"] = 2
+                        raise ValueError("abort")
+                except ValueError:
+                    pass
+                assert "x" not in s1
+                assert "y" not in data
+
+                try:
+                    with data.transaction():
+                        data["y"] = 2
+                        s1["x"] = 1
+                        raise ValueError("abort")
+                except ValueError:
+                    pass
+                assert "x" not in s1
+                assert "y" not in data
+
+        # mode is detected from the file
+        with PDS(name="data_sf", verbose=VERBOSE) as data:
+            assert data["k"] == 1
+            with data["s1"] as s1:
+                assert s1["k"] == 2
+                assert "tmp" not in s1
+                assert np.all(s1["a"] == a)
+                with s1["s2"] as s2:
+                    assert s2["k"] == 3
+                    assert np.all(s2["a"] == a)
+
+                # copy between the storage modes
+                with PDS(name="data_dirs", verbose=VERBOSE) as data_dirs:
+                    data_dirs["copy"] = s1
+                    with data_dirs["copy"] as c:
+                        assert c["k"] == 2
+                        with c["s2"] as s2:
+                            assert np.all(s2["a"] == a)
+                    with data_dirs["copy"] as c:
+                        data["copy"] = c
+
+            with data["copy"] as c:
+                assert c["k"] == 2
+                with c["s2"] as s2:
+                    assert s2["k"] == 3
+                    assert np.all(s2["a"] == a)
+
+            with PDS(name="data_dirs", verbose=VERBOSE) as data_dirs:
+                data_dirs.mergeOtherPDS(
+                    other_db_name="data_sf", update="update", status_interval=0
+                )
+                with data_dirs["s1"] as s1:
+                    with s1["s2"] as s2:
+                        assert s2["k"] == 3
+
+            with data["s1"] as s1:
+                s1.clear()
+                assert len(s1) == 0
+            assert len(os.listdir(data._dirname)) == 3
+    finally:
+        if data is not None:
+            data.erase()
+            assert not exists(data._dirname)
+        if data_dirs is not None:
+            data_dirs.erase()
+
+
+def test_cache():
+    data = None
+    try:
+        with PDS(name="data_cache", verbose=VERBOSE, cache_bytes=10000) as data:
+            data["o"] = CountLoads(1)
+            data[1] = "one"
+            data["big"] = b"x" * 20000
+            data["a"] = np.arange(5)
+            CountLoads.loads = 0
+            for i in range(10):
+                assert data["o"].x == 1
+                assert data[1] == "one"
+                assert data["big"] == b"x" * 20000
+                assert np.all(data["a"] == np.arange(5))
+            assert CountLoads.loads == 1
+            info = data.cache_info()
+            assert info["hits"] == 9 and info["entries"] == 1
+
+            # invalidation
+            data["o"] = CountLoads(2)
+            assert data["o"].x == 2
+            try:
+                with data.transaction():
+                    data["o"] = CountLoads(3)
+                    assert data["o"].x == 3
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+            assert data["o"].x == 2
+            del data["o"]
+            assert "o" not in data
+            try:
+                data["o"]
+            except KeyError:
+                pass
+            else:
+                assert False
+            data.update({"o": 4, "p": 5})
+            assert data.get_many(["o", "p", "o"], as_dict=False) == [4, 5, 4]
+            assert data.get_many(["o", "p"]) == {"o": 4, "p": 5}
+            assert data.cache_info()["entries"] == 2
+            data.clear()
+            assert data.cache_info()["entries"] == 0
+            assert data.get_many(["o"], default=None) == {"o": None}
+
+            # LRU eviction by size
+            for i in range(100):
+                data[str(i)] = b"y" * 400
+                data[str(i)]
+            info = data.cache_info()
+            assert info["bytes"] <= 10000 and 0 < info["entries"] < 100
+            assert "99" in data._cache and "0" not in data._cache
+    finally:
+        if data is not None:
+            data.erase()
+
+
+def test_pool():
+    for single_file in [False, True]:
+        data = None
+        try:
+            with PDS(
+                name="data_pool", verbose=VERBOSE, single_file=single_file, pool_size=2
+            ) as data:
+                for i in range(4):
+                    with data.newSubData(i) as s:
+                        with s.newSubData("x") as x:
+                            x["v"] = i
+                # only two of the idle handles are kept open
+                assert len(data._pool) == 2
+
+                for j in range(3):
+                    for i in range(4):
+                        with data[i] as s:
+                            with s["x"] as x:
+                                assert x["v"] == i
+                assert len(data._pool) == 2
+
+                s0 = data[0]
+                assert data[0] is s0
+                s0.close()
+                s0.close()
+                assert s0.is_open()
+                with data[0] as s:
+                    with s["x"] as x:
+                        x["w"] = 1
+                for i in [2, 3]:
+                    with data[i]:
+                        pass
+                assert s0.is_closed()
+                with data[1] as s1:
+                    del data[1]
+                    assert 1 not in data
+                with data[0]["x"] as x:
+                    assert x["w"] == 1
+                # handles in use are closed with the root
+                s2 = data[2]
+            assert s2.is_closed()
+            if not single_file:
+                assert len(os.listdir(data._dirname)) == 1 + 3
+        finally:
+            if data is not None:
+                data.erase()
+
+
+def test_lazy():
+    data = None
+    try:
+        data = PDS(name="data_lazy", path="__lazy_path", verbose=VERBOSE, lazy=True)
+        assert data.is_closed()
+        assert not exists("__lazy_path")
+        data["a"] = 1
+        assert data.is_open()
+        with data.newSubData("s") as s:
+            s["b"] = 2
+        data.close()
+
+        with PDS(
+            name="data_lazy", path="__lazy_path", verbose=VERBOSE, lazy=True
+        ) as data:
+            s = data["s"]
+            assert s.is_closed()
+            assert s["b"] == 2
+            s.close()
+            # reopened on demand
+            assert s["b"] == 2
+            s.close()
+            assert data["a"] == 1
+        assert data.is_closed()
+        assert data.get_value_and_value_type("a") == (0, 1)
+        data.close()
+        assert data.is_closed()
+        assert len(data) == 2
+        data.close()
+
+        with PDS(
+            name="data_lazy_sf",
+            path="__lazy_path",
+            verbose=VERBOSE,
+            lazy=True,
+            single_file=True,
+        ) as data_sf:
+            with data_sf.newSubData("s") as s:
+                s["b"] = 2
+        with data_sf["s"] as s:
+            assert s["b"] == 2
+        data_sf.erase()
+    finally:
+        if data is not None:
+            data.erase()
+        rmtree("__lazy_path", ignore_errors=True)
+
+
+def test_iter_types():
+    for single_file in [False, True]:
+        data = None
+        try:
+            with PDS(
+                name="data_iter", verbose=VERBOSE, single_file=single_file
+            ) as data:
+                data["o1"] = CountLoads(1)
+                with data.newSubData("s1") as s:
+                    s["o"] = CountLoads(2)
+                data["a1"] = np.arange(3)
+                data["o2"] = CountLoads(3)
+                data.newSubData("s2").close()
+                data.append_array("a2", [1, 2])
+                if not single_file:
+                    # rows written without value type
+                    data.db["o3"] = CountLoads(4)
+                    data.db["a3"] = {"fname": "x.npy", "magic": pd.MAGIC_SIGN_NPARRAY}
+                    data.db.commit()
+
+                CountLoads.loads = 0
+                assert list(data.iter_subdata()) == ["s1", "s2"]
+                arrays = ["a1", "a2"] + (["a3"] if not single_file else [])
+                assert list(data.iter_arrays()) == arrays
+                ordinary = ["o1", "o2"] + (["o3"] if not single_file else [])
+                assert list(data.iter_ordinary()) == ordinary
+                markers = dict(data.iter_subdata(with_marker=True))
+                assert ("node" in markers["s1"]) == single_file
+                markers = dict(data.iter_arrays(with_marker=True))
+                assert "fname" in markers["a1"] and "chunks" in markers["a2"]
+                with data["s1"] as s:
+                    assert list(s.iter_ordinary()) == ["o"]
+                    assert list(s.iter_subdata()) == []
+                # only the row without value type is loaded (once for each scan)
+                assert CountLoads.loads == (5 if not single_file else 0)
+                if not single_file:
+                    del data.db["a3"]
+                    data.db.commit()
+        finally:
+            if data is not None:
+                data.erase()
+
+
+def test_keys_range():
+    for single_file in [False, True]:
+        data = None
+        try:
+            with PDS(
+                name="data_keys", verbose=VERBOSE, single_file=single_file
+            ) as data:
+                keys = ["p=0.3_{}".format(i) for i in range(5)]
+                keys += ["p=0.2_1", "p=0.4", "q", "p=0.3"]
+                for k in keys[::-1]:
+                    data[k] = k
+                data[b"bin"] = 1
+                data["p=\U0010ffff"] = 2
+                with data.newSubData("p=0.3_s") as s:
+                    s["p=0.3_x"] = 1
+
+                p3 = sorted(["p=0.3"] + keys[:5] + ["p=0.3_s"])
+                assert list(data.keys(prefix="p=0.3")) == p3
+                assert list(data.keys(prefix="p=0.3", limit=2, offset=1)) == p3[1:3]
+                assert list(data.keys(prefix="p=0.3", offset=6)) == p3[6:]
+                assert list(data.keys(start="p=0.3", stop="p=0.4")) == p3
+                assert list(data.keys(prefix="p=", start="p=0.3z")) == [
+                    "p=0.4",
+                    "p=\U0010ffff",
+                ]
+                assert list(data.keys(prefix="p=\U0010ffff")) == ["p=\U0010ffff"]
+                all_str = sorted(keys + ["p=0.3_s", "p=\U0010ffff"])
+                assert list(data.keys(prefix="")) == all_str
+                assert list(data.keys(prefix=b"b")) == [b"bin"]
+                assert list(data.keys())[-1] == b"bin"
+                assert len(list(data.keys())) == len(data)
+
+                items = list(data.items(prefix="p=0.3_"))
+                assert [k for k, v in items] == p3[1:]
+                for k, v in items:
+                    if k == "p=0.3_s":
+                        assert v["p=0.3_x"] == 1
+                        v.close()
+                    else:
+                        assert v == k
+        finally:
+            if data is not None:
+                data.erase()
+
+
+def test_items_streaming():
+    for single_file in [False, True]:
+        data = None
+        try:
+            with PDS(
+                name="data_items", verbose=VERBOSE, single_file=single_file
+            ) as data:
+                keys = ["k{:03}".format(i) for i in range(100)]
+                data.update({k: i for i, k in enumerate(keys)})
+                data["a"] = np.arange(3)
+                with data.newSubData("s") as s:
+                    s["x"] = 1
+                data[b"bin"] = "b"
+
+                for fetch_size in [1, 7, 100, 1000]:
+                    assert list(data.keys(prefix="k", fetch_size=fetch_size)) == keys
+                    items = list(data.items(prefix="k", fetch_size=fetch_size))
+                    assert items == [(k, i) for i, k in enumerate(keys)]
+                    assert list(data.values(prefix="k", fetch_size=fetch_size)) == list(
+                        range(100)
+                    )
+                    page = list(
+                        data.keys(
+                            prefix="k", limit=15, offset=10, fetch_size=fetch_size
+                        )
+                    )
+                    assert page == keys[10:25]
+                    assert len(list(data.keys(fetch_size=fetch_size))) == len(data)
+
+                values = data.values(start="a", stop="b", mmap_mode="r")
+                assert isinstance(next(values), np.memmap)
+                assert list(values) == []
+                with next(data.values(prefix="s")) as s:
+                    assert s["x"] == 1
+                assert list(data.items(prefix=b"")) == [(b"bin", "b")]
+        finally:
+            if data is not None:
+                data.erase()
+
+
+def test_async():
+    import asyncio
+
+    rmtree("__data_async", ignore_errors=True)
+
+    async def run():
+        async with pd.AsyncPersistentDataStructure(
+            name="data_async", verbose=VERBOSE
+        ) as data:
+            assert data.pds.is_closed()
+            await asyncio.gather(*[data.set(i, i) for i in range(100)])
+            assert await data.len() == 100
+            assert data.pds._tx_depth == 0
+
+            data.pds["o"] = CountLoads(1)
+            CountLoads.loads = 0
+            values = await asyncio.gather(*[data.get("o") for i in range(10)])
+            assert CountLoads.loads == 1
+            assert all(v is values[0] for v in values)
+
+            # a write issued before a read is seen by the read
+            r = await asyncio.gather(data.set("o", 2), data.get("o"))
+            assert r[1] == 2
+
+            r = await asyncio.gather(
+                data.delete("o"), data.delete("o"), return_exceptions=True
+            )
+            assert r[0] is None and isinstance(r[1], KeyError)
+            assert not await data.contains("o")
+
+            r = await asyncio.gather(data.set("o", 3), data.contains("o"), data.len())
+            assert r[1:] == [True, 101]
+            r = await asyncio.gather(
+                data.delete("o"), data.contains("o"), data.get_many(["o"], default=None)
+            )
+            assert r[1:] == [False, {"o": None}]
+
+            assert await data.get_many([1, 2]) == {1: 1, 2: 2}
+            await data.set("a", np.arange(3))
+
+            # a failing write of a batch does not affect the others
+            r = await asyncio.gather(
+                data.set("a", threading.Lock()),
+                data.set("b", 1),
+                return_exceptions=True,
+            )
+            assert isinstance(r[0], TypeError) and r[1] is None
+            assert np.all(await data.get("a") == np.arange(3))
+            assert await data.get("b") == 1
+            await data.delete("b")
+            data.pds.newSubData("s").close()
+            s = await data.get("s")
+            await s.set("x", 1)
+            assert await s.get("x") == 1
+            await s.close()
+
+            keys = []
+            async for k, v in data.items(fetch_size=7, prefix="", stop="b"):
+                keys.append(k)
+            assert keys == sorted(str(i) for i in range(100)) + ["a"]
+            async for k, v in data.items(prefix="s"):
+                assert await v.get("x") == 1
+                await v.close()
+        assert data.pds.is_closed()
+        return data
+
+    data = None
+    try:
+        data = asyncio.run(run())
+    finally:
+        if data is not None:
+            data.pds.erase()
+
+
+def test_multi_writer():
+    n_proc = 4
+
+    def write(arg, single_file):
+        with PDS(
+            name="data_mw",
+            verbose=VERBOSE,
+            multi_writer=True,
+            busy_timeout=30,
+            single_file=single_file,
+        ) as data:
+            for i in range(30):
+                data["{}_{}".format(arg, i)] = i
+            data.update({"{}_u{}".format(arg, i): i for i in range(30)})
+            data["a_{}".format(arg)] = np.arange(10) + arg
+            with data.getData("shared", create_sub_data=True) as s:
+                s[str(arg)] = arg
+            with data.newSubData("sub_{}".format(arg)) as s:
+                s.append_array("x", [arg])
+
+    for single_file in [False, True]:
+        data = None
+        try:
+            with PDS(
+                name="data_mw",
+                verbose=VERBOSE,
+                multi_writer=True,
+                single_file=single_file,
+            ) as data:
+                pass
+            procs = [
+                mp.Process(target=write, args=(i, single_file)) for i in range(n_proc)
+            ]
+            for p in procs:
+                p.start()
+            for p in procs:
+                p.join(60)
+                assert p.exitcode == 0
+
+            with PDS(name="data_mw", verbose=VERBOSE, multi_writer=True) as data:
+                assert len(data) == n_proc * (60 + 2) + 1
+                with data["shared"] as s:
+                    assert sorted(s.keys()) == [str(i) for i in range(n_proc)]
+                for i in range(n_proc):
+                    assert np.all(data["a_{}".format(i)] == np.arange(10) + i)
+                    with data["sub_{}".format(i)] as s:
+                        assert np.all(s["x"] == [i])
+                if not single_file:
+                    # no directory left behind by the creation of 'shared'
+                    n_dirs = len(
+                        [f for f in os.listdir(data._dirname) if f.startswith("__")]
+                    )
+                    assert n_dirs == n_proc + 1
+        finally:
+            if data is not None:
+                data.erase()
+
+
+def test_read_only():
+    a = np.arange(10)
+    data = None
+    try:
+        with PDS(name="data_ro", verbose=VERBOSE) as data:
+            data["x"] = 1
+            data["a"] = a
+            with data.newSubData("s") as s:
+                s["y"] = 2
+        # a store written by an older version (no value type column)
+        os.mkdir(join(data._dirname, "__old"))
+        with sqd.SqliteDict(
+            join(data._dirname, "__old", "old.db"), autocommit=True
+        ) as d:
+            d["o"] = 3
+            d["s"] = {"name": "s", "magic": pd.MAGIC_SIGN}
+        mtime = os.path.getmtime(data._filename)
+
+        for immutable in [False, True]:
+            with PDS(
+                name="data_ro", verbose=VERBOSE, mode="r", immutable=immutable
+            ) as data_r:
+                assert data_r["x"] == 1
+                assert np.all(data_r["a"] == a)
+                assert sorted(data_r.keys()) == ["a", "s", "x"]
+                with data_r["s"] as s:
+                    assert s["y"] == 2
+                    for f in [
+                        partial(s.setData, "z", 1),
+                        partial(s.__delitem__, "y"),
+                        s.clear,
+                        s.erase,
+                    ]:
+                        try:
+                            f()
+                        except PermissionError:
+                            pass
+                        else:
+                            assert False
+                for f in [
+                    partial(data_r.__setitem__, "x", 2),
+                    partial(data_r.getData, "n", create_sub_data=True),
+                    partial(data_r.update, {"x": 2}),
+                    partial(data_r.append_array, "a", [1]),
+                ]:
+                    try:
+                        f()
+                    except PermissionError:
+                        pass
+                    else:
+                        assert False
+                assert data_r["x"] == 1
+
+        with PDS(name="old", path=data._dirname, verbose=VERBOSE, mode="r") as old:
+            assert old["o"] == 3
+            assert old.is_subdata("s") and not old.is_subdata("o")
+            assert list(old.iter_ordinary()) == ["o"]
+            assert len(old) == 2
+            columns = [r[1] for r in old.db.conn.select('PRAGMA table_info("unnamed")')]
+            assert "vtype" not in columns
+        assert os.path.getmtime(data._filename) == mtime
+
+        try:
+            PDS(name="data_ro", path="__ro_missing", verbose=VERBOSE, mode="r")
+        except Exception:
+            pass
+        else:
+            assert False
+        assert not exists("__ro_missing")
+    finally:
+        if data is not None:
+            rmtree(join(data._dirname, "__old"), ignore_errors=True)
+            data.erase()
+
+
+def _read_key(data, key):
+    with data:
+        return data[key]
+
+
+def test_fork_and_pickle():
+    ctx = mp.get_context("fork")
+    for single_file in [False, True]:
+        data = None
+        try:
+            data = PDS(
+                name="data_fork", verbose=VERBOSE, single_file=single_file, pool_size=2
+            )
+            data["x"] = 1
+            s = data.getData("s", create_sub_data=True)
+            s["y"] = 2
+
+            def child(i):
+                # uses the handles opened by the parent
+                assert data["x"] == 1
+                assert s["y"] == 2
+                data["c{}".format(i)] = i
+                with data["s"] as s2:
+                    s2["c{}".format(i)] = i
+                s.close()
+                data.close()
+
+            procs = [ctx.Process(target=child, args=(i,)) for i in range(3)]
+            for p in procs:
+                p.start()
+            for p in procs:
+                p.join(30)
+                assert p.exitcode == 0
+
+            # the parent is not affected
+            assert data["c2"] == 2
+            assert s["c1"] == 1
+            s["z"] = 3
+            assert len(data) == 5
+
+            # pickled by path
+            data2 = pickle.loads(pickle.dumps(data))
+            assert data2.is_closed()
+            assert data2["x"] == 1
+            s2 = pickle.loads(pickle.dumps(s))
+            assert s2["z"] == 3
+            s2.close()
+            data2.close()
+            with ctx.Pool(2) as pool:
+                r = pool.starmap(_read_key, [(data, "x"), (s, "y"), (data, "c0")])
+                assert r == [1, 2, 0]
+            s.close()
+            data.close()
+        finally:
+            if data is not None:
+                data.erase()
+
+
+def test_move_subdata():
+    a = np.arange(10)
+    d1 = None
+    d2 = None
+    d3 = None
+    try:
+        with PDS(name="d1", verbose=VERBOSE) as d1:
+            d1.clear()
+            with d1.newSubData("sub") as sub:
+                sub["a"] = a
+                with sub.newSubData("deep") as deep:
+                    deep["x"] = 1
+                sub_dir = sub._dirname
+                fname = [f for f in os.listdir(sub_dir) if f.endswith(".npy")][0]
+                ino = os.stat(join(sub_dir, fname)).st_ino
+
+            with PDS(name="d2", verbose=VERBOSE) as d2:
+                d2.clear()
+                d1.move_subdata("sub", d2, "moved")
+                assert "sub" not in d1
+                assert not os.path.exists(sub_dir)
+                with d2["moved"] as sub:
+                    assert np.all(sub["a"] == a)
+                    assert sub["deep"]["x"] == 1
+                    assert os.stat(join(sub._dirname, fname)).st_ino == ino
+
+                    try:
+                        d2.move_subdata("moved", sub, "self")
+                    except ValueError:
+                        pass
+                    else:
+                        assert False, "ValueError expected"
+
+                d2.move_subdata("moved", d2, "renamed")
+                assert list(d2.keys()) == ["renamed"]
+                assert d2["renamed"]["deep"]["x"] == 1
+
+                # a move within the same PDS is rolled back with the transaction
+                try:
+                    with d2.transaction():
+                        d2.move_subdata("renamed", d2, "tmp")
+                        raise ZeroDivisionError
+                except ZeroDivisionError:
+                    pass
+                assert list(d2.keys()) == ["renamed"]
+                with d2["renamed"] as sub:
+                    assert np.all(sub["a"] == a)
+                    assert sub["deep"]["x"] == 1
+                assert len(os.listdir(d2._dirname)) == 2
+
+                # to an other PDS only outside of a transaction
+                with d2.transaction():
+                    try:
+                        d2.move_subdata("renamed", d1, "back")
+                    except RuntimeError:
+                        pass
+                    else:
+                        assert False, "RuntimeError expected"
+                assert "back" not in d1
+                assert d2["renamed"]["deep"]["x"] == 1
+
+        with PDS(name="d3", verbose=VERBOSE, single_file=True) as d3:
+            d3.clear()
+            with d3.newSubData("s1") as s1, d3.newSubData("t") as t:
+                with s1.newSubData("s2") as s2:
+                    s2["a"] = a
+                s1.move_subdata("s2", t, "s2")
+                assert len(s1) == 0
+                assert np.all(t["s2"]["a"] == a)
+            d3.move_subdata("t", d3, "t2")
+        with PDS(name="d3", verbose=VERBOSE, single_file=True) as d3:
+            assert sorted(d3.keys()) == ["s1", "t2"]
+            assert np.all(d3["t2"]["s2"]["a"] == a)
+    finally:
+        for d in (d1, d2, d3):
+            if d is not None:
+                d.erase()
+
+
+def test_fast_erase():
+    a = np.arange(10)
+
+    def fill(data):
+        data["a"] = a
+        data["x"] = 1
+        for i in range(5):
+            with data.newSubData("sub{}".format(i)) as sub:
+                sub["a"] = a
+                with sub.newSubData("deep") as deep:
+                    deep["a"] = a
+
+    data = None
+    try:
+        with PDS(name="data", verbose=VERBOSE, pool_size=2) as data:
+            data.clear()
+            fill(data)
+            data["sub0"].close()
+            data.clear(fast=True, workers=4)
+            assert len(data) == 0
+            assert os.listdir(data._dirname) == ["data.db"]
+
+            # entries written after clear in the same transaction are kept
+            fill(data)
+            with data.transaction():
+                data.clear(fast=True)
+                data["new"] = a
+                with data.newSubData("s") as s:
+                    s["x"] = 1
+            assert np.all(data["new"] == a)
+            assert data["s"]["x"] == 1
+
+            # rollback restores the entries
+            try:
+                with data.transaction():
+                    data.clear(fast=True)
+                    data["new2"] = a
+                    raise ZeroDivisionError
+            except ZeroDivisionError:
+                pass
+            assert sorted(data.keys()) == ["new", "s"]
+            assert np.all(data["new"] == a)
+            assert data["s"]["x"] == 1
+            data.clear()
+
+            fill(data)
+            data.clear(fast=True, background=True)
+            assert len(data) == 0
+            for i in range(100):
+                if os.listdir(data._dirname) == ["data.db"]:
+                    break
+                time.sleep(0.05)
+            assert os.listdir(data._dirname) == ["data.db"]
+
+            fill(data)
+            thread = data.erase(fast=True, background=True, workers=2)
+            assert not os.path.exists(data._dirname)
+            thread.join()
+            assert not [f for f in os.listdir(".") if f.startswith("__data.erase-")]
+            data = None
+
+        with PDS(name="data", verbose=VERBOSE, autocommit=False) as data:
+            fill(data)
+            data.commit()
+            data.clear(fast=True)
+            data["new"] = a
+            data.commit()
+            assert np.all(data["new"] == a)
+            data.erase(fast=True)
+            data = None
+
+        with PDS(name="data_sf", verbose=VERBOSE, single_file=True) as data:
+            fill(data)
+            data.clear(fast=True)
+            assert len(data) == 0
+            assert os.listdir(data._dirname) == ["data_sf.db"]
+            assert data.db.conn.select_one('SELECT COUNT(*) FROM "subdata"')[0] == 0
+            fill(data)
+            data.erase(fast=True)
+            assert not os.path.exists(data._dirname)
+            data = None
+    finally:
+        if data is not None:
+            data.erase()
+
+
 if __name__ == "__main__":
     test_pd()
     test_pd_bytes()
@@ -661,6 +2059,31 @@ if __name__ == "__main__":
     test_clear()
     test_not_in()
     test_npa()
+    test_npa_mmap()
+    test_npa_inline()
+    test_append_array()
+    test_compression()
+    test_serializer()
     test_merge()
+    test_merge_bulk()
+    test_merge_workers()
+    test_link_mode()
     test_merge_fname_conflict()
+    test_transaction()
+    test_set_many()
+    test_get_many()
+    test_value_type_column()
+    test_single_file()
+    test_cache()
+    test_pool()
+    test_lazy()
+    test_iter_types()
+    test_keys_range()
+    test_items_streaming()
+    test_async()
+    test_multi_writer()
+    test_read_only()
+    test_fork_and_pickle()
+    test_move_subdata()
+    test_fast_erase()
     pass